@@ -1,13 +1,33 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
-import subprocess
 import os
 import uuid
+import hashlib
+import shutil
+import json
+from functools import partial
 from fastapi.middleware.cors import CORSMiddleware
-import ffmpeg
 from fastapi.staticfiles import StaticFiles
-from typing import Optional
+from fastapi.responses import JSONResponse
+from typing import Optional, List
 import logging
-from video_processing import upscale_with_realesrgan
+import asyncio
+import signal
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from video_processing import (
+    upscale_with_realesrgan, preview_upscale, get_work_roots, probe_media, planned_frame_format,
+    FRAME_RATE_MODES, FRAME_FORMATS
+)
+from remux import plan_remux, remux_command
+from renditions import parse_renditions, rendition_outputs, PACKAGINGS, MP4
+from storage import StorageManager, InsufficientStorage
+from jobs import JobRegistry, RUNNING, DONE, FAILED, CANCELLED
+from supervisor import JobControl, JobCancelled, JobInterrupted, run_controlled, run_process, interrupt_running
+from budget import DeadlineExceeded
+from tracing import Trace, current_trace, span, run_profiled
+from resources import tuning
+from capabilities import get_capabilities
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -29,10 +49,12 @@ if not os.path.exists("videos"):
 # Serve static files from the videos directory
 app.mount("/videos", StaticFiles(directory="videos"), name="videos")
 
-def analyze_video(input_path: str) -> dict:
+def analyze_video(input_path: str, probe: Optional[dict] = None) -> dict:
     """Analyze video file and return metadata"""
     try:
-        probe = ffmpeg.probe(input_path)
+        probe = probe or probe_media(input_path)
+        if not probe:
+            raise ValueError("ffprobe could not read the file")
         video_streams = [stream for stream in probe['streams'] if stream['codec_type'] == 'video']
         audio_streams = [stream for stream in probe['streams'] if stream['codec_type'] == 'audio']
         
@@ -66,92 +88,748 @@ def get_temp_dir() -> str:
         return tmp
     return "videos"
 
-@app.post("/upload")
-async def upscale_video_endpoint(
-    request: Request,
-    file: UploadFile = File(...),
-    resolution: str = Form("1920:1080")  # Frontend sends resolution like "1920:1080"
-):
-    """Upload and upscale video to specified resolution using Real-ESRGAN"""
-    # Validate file type
-    if not file.content_type.startswith('video/'):
-        raise HTTPException(status_code=400, detail="File must be a video")
+storage = StorageManager(get_temp_dir(), get_work_roots())
 
-    # Convert resolution to scale factor
+# Upscale jobs (uploads, previews and batch items) are queued on a pool of
+# workers; each worker runs one job at a time. The pool is sized from the
+# CPUs, memory and temp space of the host unless JOB_WORKERS is set
+JOB_WORKERS = tuning()["job_workers"]
+DISCONNECT_POLL = 1.0  # Seconds between checks that the client of a running job is still there
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 50))
+BATCH_INPUT_ROOT = os.getenv('BATCH_INPUT_ROOT')  # Server dir batch manifests may reference
+job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+jobs = JobRegistry()
+
+# Graceful shutdown: on SIGTERM new jobs are refused with 503 and running
+# jobs get DRAIN_TIMEOUT seconds to finish before they are interrupted,
+# keeping their checkpoints so a retry resumes them
+DRAIN_TIMEOUT = int(os.getenv('DRAIN_TIMEOUT', 25))
+JOB_ENDPOINTS = ("/upload", "/preview", "/batch", "/fix-audio")
+draining = threading.Event()
+
+async def run_job(request: Request, call, executor=job_pool, control: Optional[JobControl] = None,
+                  name: str = "job"):
+    """
+    Run a blocking pipeline call in a worker thread under a JobControl and
+    return its result. When the client disconnects first, the job's
+    processes are killed and JobCancelled is raised once its thread is done.
+    The call sees the caller's current trace and is profiled as `name`
+    when profiling is on.
+    """
+    control = control or JobControl()
+    future = asyncio.get_running_loop().run_in_executor(
+        executor, contextvars.copy_context().run, run_controlled, control, run_profiled, name, call
+    )
+    while True:
+        done, _ = await asyncio.wait({future}, timeout=DISCONNECT_POLL)
+        if done:
+            return future.result()
+        if not control.cancelled.is_set() and await request.is_disconnected():
+            logger.info(f"Client disconnected from {request.url.path}, cancelling job")
+            control.cancel()
+
+def job_stopped(job_id: Optional[str], error: JobCancelled) -> HTTPException:
+    """Record a cancelled or interrupted job and return the error response for it"""
+    if isinstance(error, JobInterrupted):
+        jobs.update(job_id, status=FAILED, error="Interrupted by server shutdown")
+        return HTTPException(status_code=503, detail="Server is shutting down, retry the request",
+                             headers={"Retry-After": "1"})
+    jobs.update(job_id, status=CANCELLED)
+    return HTTPException(status_code=499, detail="Client closed request")
+
+def begin_drain():
+    """Stop taking jobs, and interrupt those still running after DRAIN_TIMEOUT"""
+    if draining.is_set():
+        return
+    draining.set()
+    logger.info(f"Draining: refusing new jobs, running jobs have {DRAIN_TIMEOUT}s to finish")
+    timer = threading.Timer(DRAIN_TIMEOUT, interrupt_jobs)
+    timer.daemon = True
+    timer.start()
+
+def interrupt_jobs():
+    count = interrupt_running()
+    if count:
+        logger.warning(f"Interrupted {count} jobs still running after {DRAIN_TIMEOUT}s, checkpoints kept")
+
+async def periodic_storage_sweep():
+    """Sweep expired outputs and orphaned work dirs in the background"""
+    while True:
+        await asyncio.sleep(storage.sweep_interval)
+        try:
+            await asyncio.to_thread(storage.sweep)
+        except Exception as e:
+            logger.error(f"Storage sweep failed: {e}", exc_info=True)
+
+@app.on_event("startup")
+async def start_storage_manager():
+    """Clean up what crashed jobs left behind before accepting work"""
+    freed = await asyncio.to_thread(storage.sweep)
+    logger.info(f"Startup storage sweep freed {freed} bytes, usage: {storage.usage()}")
+    asyncio.create_task(periodic_storage_sweep())
+
+@app.on_event("startup")
+async def scan_capabilities():
+    """Find missing tools and models now rather than on the first job"""
+    capabilities = await asyncio.to_thread(get_capabilities)
+    for error in capabilities["errors"]:
+        logger.error(f"Capability check: {error}")
+    for warning in capabilities["warnings"]:
+        logger.warning(f"Capability check: {warning}")
+
+@app.on_event("startup")
+async def install_drain_handler():
+    """Start draining on SIGTERM, then let the server's own handler stop accepting connections"""
+    if threading.current_thread() is not threading.main_thread():
+        return  # Signals only reach the main thread, e.g. not under a TestClient
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_term(sig, frame):
+        loop.call_soon_threadsafe(begin_drain)
+        if callable(previous):
+            previous(sig, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+@app.on_event("shutdown")
+async def drain_jobs():
+    """Wait for running jobs (interrupted after DRAIN_TIMEOUT) and drop queued ones"""
+    begin_drain()
+    await asyncio.to_thread(job_pool.shutdown, wait=True, cancel_futures=True)
+
+# The middlewares below are plain ASGI apps: under Starlette's
+# BaseHTTPMiddleware (@app.middleware) a route never sees its client
+# disconnect, so run_job could not cancel the job of a client that left
+class RefuseJobsWhileDraining:
+    """Send new jobs elsewhere once the server is shutting down"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] == "http" and draining.is_set() and scope["method"] == "POST"
+                and scope["path"] in JOB_ENDPOINTS):
+            response = JSONResponse(status_code=503, content={"detail": "Server is shutting down"},
+                                    headers={"Retry-After": "1", "Connection": "close"})
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+class TrackOutputAccess:
+    """Record downloads so the least recently used outputs are evicted first"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "GET" and scope["path"].startswith("/videos/"):
+            # Files of a multi-rendition output count as accesses to its directory
+            storage.touch(scope["path"][len("/videos/"):].split("/")[0])
+        await self.app(scope, receive, send)
+
+app.add_middleware(TrackOutputAccess)
+app.add_middleware(RefuseJobsWhileDraining)
+
+def resolution_to_scale(resolution: str) -> str:
+    """Convert a target resolution like "1920:1080" (or a bare scale) to a scale factor"""
     try:
         if ":" in resolution:
             width, height = map(int, resolution.split(":"))
             # Determine scale based on target resolution
             if width >= 3840 or height >= 2160:  # 4K
-                scale = "4"
+                return "4"
             elif width >= 2560 or height >= 1440:  # 2K
-                scale = "3"
+                return "3"
             elif width >= 1920 or height >= 1080:  # 1080p
-                scale = "2"
+                return "2"
             else:  # 720p or lower
-                scale = "2"
+                return "2"
         else:
             # Fallback to direct scale value
             scale = resolution
             if scale not in ["2", "3", "4"]:
                 scale = "2"
+            return scale
     except:
-        scale = "2"  # Default to 2x upscaling
+        return "2"  # Default to 2x upscaling
 
-    uid = str(uuid.uuid4())
-    temp_dir = get_temp_dir()
-    input_path = os.path.join(temp_dir, f"{uid}_{file.filename}")
-    output_path = os.path.join(temp_dir, f"{uid}_upscaled.mp4")
+async def save_upload(file: UploadFile, input_path: str):
+    """
+    Save uploaded file and check size (optimized for memory).
+    Returns the size and the SHA-256 hex digest of the contents.
+    """
+    total_size = 0
+    digest = hashlib.sha256()
+    with open(input_path, "wb") as f:
+        while True:
+            chunk = await file.read(1024 * 1024)  # 1MB chunks
+            if not chunk:
+                break
+            total_size += len(chunk)
+            if total_size > 100 * 1024 * 1024:
+                f.close()
+                os.remove(input_path)
+                raise HTTPException(status_code=400, detail="File size must be less than 100MB")
+            digest.update(chunk)
+            f.write(chunk)
+    logger.info(f"Saved uploaded file to {input_path}")
+    return total_size, digest.hexdigest()
+
+def get_job_key(digest: str, scale: str, time_ranges: Optional[list] = None,
+                frame_rate_mode: str = "native", temporal: bool = False) -> str:
+    """
+    Same content, scale and processing options map to the same job, so a
+    retried upload resumes from the checkpoint of the failed one and reuses
+    frames of its preview
+    """
+    key = f"{digest[:32]}_x{scale}"
+    if frame_rate_mode != "native":
+        key += f"_{frame_rate_mode}"
+    if temporal:
+        key += "_temporal"
+    if time_ranges:
+        selection = ",".join(f"{start:g}-{end:g}" for start, end in time_ranges)
+        key += "_t" + hashlib.sha1(selection.encode()).hexdigest()[:12]
+    return key
+
+def parse_time_ranges(start: Optional[float], end: Optional[float], ranges: Optional[str],
+                      duration: float) -> Optional[list]:
+    """
+    Parse the requested time selection: start/end seconds, or ranges like
+    "10-20,30.5-40". Returns sorted [start, end] pairs clipped to the
+    duration, or None to process the whole video.
+    """
+    pairs = []
+    try:
+        if ranges:
+            for part in ranges.split(","):
+                range_start, range_end = part.strip().split("-")
+                pairs.append([float(range_start), float(range_end)])
+        elif start is not None or end is not None:
+            pairs.append([start or 0.0, end if end is not None else duration])
+    except ValueError:
+        raise HTTPException(status_code=400, detail='ranges must look like "10-20,30.5-40"')
+    if not pairs:
+        return None
 
+    pairs.sort()
+    for i, (range_start, range_end) in enumerate(pairs):
+        if duration:
+            range_end = min(range_end, duration)
+            pairs[i][1] = range_end
+        if range_start < 0 or range_end <= range_start:
+            raise HTTPException(status_code=400, detail=f"Invalid time range {range_start}-{range_end}")
+        if i and range_start < pairs[i - 1][1]:
+            raise HTTPException(status_code=400, detail="Time ranges must not overlap")
+    return pairs
+
+def parse_upscale_options(resolution: str, frame_rate_mode: str, renditions: Optional[str], packaging: str):
+    """
+    Validate the options shared by /upload and /batch.
+    Returns the resolution the model targets, its scale and the parsed renditions.
+    """
+    if frame_rate_mode not in FRAME_RATE_MODES:
+        raise HTTPException(status_code=400, detail=f"frame_rate_mode must be one of {list(FRAME_RATE_MODES)}")
+    if packaging not in PACKAGINGS:
+        raise HTTPException(status_code=400, detail=f"packaging must be one of {list(PACKAGINGS)}")
+    rendition_sizes = None
+    if renditions:
+        try:
+            rendition_sizes = parse_renditions(renditions)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='renditions must look like "1280:720,1920:1080"')
+        # The model runs once, at the scale the largest rendition needs
+        resolution = ":".join(map(str, rendition_sizes[0]))
+    # Convert resolution to scale factor
+    return resolution, resolution_to_scale(resolution), rendition_sizes
+
+def run_upscale_job(input_path: str, uid: str, total_size: int, digest: str, scale: str,
+                    start: Optional[float] = None, end: Optional[float] = None, ranges: Optional[str] = None,
+                    frame_rate_mode: str = "native", temporal: bool = False,
+                    rendition_sizes: Optional[list] = None, packaging: str = MP4, progress=None) -> dict:
+    """
+    Analyze a saved upload and upscale it into the output dir, reserving
+    storage for the job. Raises HTTPException when the job cannot run or
+    fails, or JobCancelled when it is cancelled, after removing its partial
+    output. Returns the output name, the analysis and the selected time
+    ranges.
+    """
+    temp_dir = get_temp_dir()
+    output_name = f"{uid}_renditions" if rendition_sizes else f"{uid}_upscaled.mp4"
+    output_path = os.path.join(temp_dir, output_name)
     try:
-        # Save uploaded file and check size (optimized for memory)
-        total_size = 0
-        with open(input_path, "wb") as f:
-            while True:
-                chunk = await file.read(1024 * 1024)  # 1MB chunks
-                if not chunk:
-                    break
-                total_size += len(chunk)
-                if total_size > 100 * 1024 * 1024:
-                    f.close()
-                    os.remove(input_path)
-                    raise HTTPException(status_code=400, detail="File size must be less than 100MB")
-                f.write(chunk)
-
-        logger.info(f"Saved uploaded file to {input_path}")
         # Analyze video
-        analysis = analyze_video(input_path)
+        with span("analyze"):
+            probe = probe_media(input_path)
+            analysis = analyze_video(input_path, probe)
         logger.info(f"Video analysis: {analysis}")
-        
-        # Upscale video using Real-ESRGAN
-        success = upscale_with_realesrgan(input_path, output_path, scale)
+        time_ranges = parse_time_ranges(start, end, ranges, analysis.get("duration") or 0)
+        job_key = get_job_key(digest, scale, time_ranges, frame_rate_mode, temporal)
+
+        # Reserve disk space up front so the job is not killed halfway by ENOSPC
+        selected = sum(range_end - range_start for range_start, range_end in time_ranges) if time_ranges else None
+        frame_format = planned_frame_format(job_key, probe, scale, time_ranges, frame_rate_mode)
+        estimate = storage.estimate_job_bytes(analysis, int(scale), total_size, selected,
+                                              len(rendition_sizes) if rendition_sizes else 1,
+                                              FRAME_FORMATS[frame_format]["compressed"])
+        try:
+            with storage.reserve(estimate, job_key, output_path):
+                # Upscale video using Real-ESRGAN
+                success = upscale_with_realesrgan(
+                    input_path, output_path, scale, job_key=job_key, probe=probe, time_ranges=time_ranges,
+                    frame_rate_mode=frame_rate_mode, temporal=temporal,
+                    renditions=rendition_sizes, packaging=packaging, progress=progress
+                )
+        except InsufficientStorage as e:
+            logger.error(f"Refusing job: {e}")
+            raise HTTPException(status_code=507, detail="Not enough storage to process this video, try again later")
+        except DeadlineExceeded as e:
+            raise HTTPException(status_code=504, detail=f"Processing would take too long: {e}")
         if not success:
             raise HTTPException(status_code=500, detail="Failed to process video with Real-ESRGAN")
+    except (HTTPException, JobCancelled):
+        if os.path.isdir(output_path):
+            shutil.rmtree(output_path, ignore_errors=True)
+        elif os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    return {"output_name": output_name, "analysis": analysis, "time_ranges": time_ranges}
+
+def output_urls(base_url: str, output_name: str, rendition_sizes: Optional[list], packaging: str):
+    """Download URL of a job output and, for multi-rendition jobs, the URL of every rendition"""
+    download_url = f"{base_url}/videos/{output_name}"
+    if not rendition_sizes:
+        return download_url, None
+    outputs = rendition_outputs(rendition_sizes, packaging)
+    rendition_urls = {name: f"{download_url}/{path}" for name, path in outputs["renditions"].items()}
+    # The manifest, or the largest rendition
+    if outputs["manifest"]:
+        return f"{download_url}/{outputs['manifest']}", rendition_urls
+    return next(iter(rendition_urls.values())), rendition_urls
+
+@app.post("/upload")
+async def upscale_video_endpoint(
+    request: Request,
+    file: UploadFile = File(...),
+    resolution: str = Form("1920:1080"),  # Frontend sends resolution like "1920:1080"
+    start: Optional[float] = Form(None),  # Seconds, to process only part of the video
+    end: Optional[float] = Form(None),
+    ranges: Optional[str] = Form(None),  # Several parts like "10-20,30.5-40", overrides start/end
+    frame_rate_mode: str = Form("native"),  # "adaptive" upscales fewer frames and interpolates the rest
+    temporal: bool = Form(False),  # Run the model on anchor frames only, warp the rest with optical flow
+    renditions: Optional[str] = Form(None),  # Several outputs like "1280:720,1920:1080,3840:2160", overrides resolution
+    packaging: str = Form(MP4)  # "mp4" files, or an "hls" / "dash" ladder of the renditions
+):
+    """
+    Upload and upscale video to specified resolution using Real-ESRGAN.
+    With start/end or ranges only those parts are decoded, upscaled and
+    joined into the output.
+    With renditions the video is upscaled once, for the largest of them,
+    and every rendition is scaled and encoded from that in a single pass.
+    """
+    resolution, scale, rendition_sizes = parse_upscale_options(resolution, frame_rate_mode, renditions, packaging)
+    # Validate file type
+    if not file.content_type.startswith('video/'):
+        raise HTTPException(status_code=400, detail="File must be a video")
+
+    uid = str(uuid.uuid4())
+    temp_dir = get_temp_dir()
+    input_path = os.path.join(temp_dir, f"{uid}_{file.filename}")
+    # Registered like batch items so the trace stays available through /jobs
+    trace = Trace()
+    current_trace.set(trace)
+    control = JobControl()
+    job_id = jobs.create("upload", control=control, trace=trace, source=file.filename, file_id=uid)
+
+    try:
+        with span("upload"):
+            total_size, digest = await save_upload(file, input_path)
+        # Kept from the storage sweep while the job waits for a worker and runs
+        storage.hold_input(input_path)
+        result = await run_job(request, partial(
+            run_upscale_job, input_path, uid, total_size, digest, scale, start=start, end=end, ranges=ranges,
+            frame_rate_mode=frame_rate_mode, temporal=temporal,
+            rendition_sizes=rendition_sizes, packaging=packaging,
+            progress=lambda stage, done, total: jobs.progress(job_id, stage, done, total)
+        ), control=control, name=job_id)
         
         # Clean up input file
         if os.path.exists(input_path):
             os.remove(input_path)
         
         # Build full download URL
-        base_url = get_base_url(request)
-        download_url = f"{base_url}/videos/{uid}_upscaled.mp4"
+        download_url, rendition_urls = output_urls(
+            get_base_url(request), result["output_name"], rendition_sizes, packaging
+        )
+        jobs.update(job_id, status=DONE, result={"download_url": download_url, "renditions": rendition_urls})
         
         return {
             "download_url": download_url,
-            "analysis": analysis,
+            "renditions": rendition_urls,
+            "packaging": packaging if rendition_sizes else None,
+            "analysis": result["analysis"],
             "resolution": resolution,
             "scale": scale,
-            "file_id": uid
+            "time_ranges": result["time_ranges"],
+            "frame_rate_mode": frame_rate_mode,
+            "temporal": temporal,
+            "file_id": uid,
+            "job_id": job_id,
+            "timings": trace.timings()
         }
     except HTTPException as he:
         logger.error(f"HTTPException: {he.detail}")
-        for path in [input_path, output_path]:
-            if os.path.exists(path):
-                os.remove(path)
+        jobs.update(job_id, status=FAILED, error=he.detail)
+        if os.path.exists(input_path):
+            os.remove(input_path)
         raise
+    except JobCancelled as e:
+        if os.path.exists(input_path):
+            os.remove(input_path)
+        raise job_stopped(job_id, e)
     except Exception as e:
         logger.error(f"Error in /upload: {e}")
+        jobs.update(job_id, status=FAILED, error="Internal server error")
         raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        storage.release_input(input_path)
+
+def hash_file(path: str):
+    """Size and SHA-256 hex digest of a file"""
+    digest = hashlib.sha256()
+    total_size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            total_size += len(chunk)
+            digest.update(chunk)
+    return total_size, digest.hexdigest()
+
+def resolve_manifest(manifest: str) -> list:
+    """
+    Resolve a batch manifest, a JSON list of paths relative to
+    BATCH_INPUT_ROOT, to absolute paths of existing files inside it
+    """
+    if not BATCH_INPUT_ROOT:
+        raise HTTPException(status_code=400, detail="Manifests are disabled, BATCH_INPUT_ROOT is not set")
+    try:
+        entries = json.loads(manifest)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="manifest must be a JSON list of paths")
+    if not isinstance(entries, list) or not all(isinstance(entry, str) for entry in entries):
+        raise HTTPException(status_code=400, detail="manifest must be a JSON list of paths")
+    root = os.path.realpath(BATCH_INPUT_ROOT)
+    paths = []
+    for entry in entries:
+        path = os.path.realpath(os.path.join(root, entry))
+        if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            raise HTTPException(status_code=400, detail=f"No such file in the batch input root: {entry}")
+        paths.append(path)
+    return paths
+
+def run_batch_item(job_id: str, input_path: str, owned: bool, uid: str, size_and_digest, base_url: str,
+                   options: dict):
+    """
+    Run one batch item in the job worker pool, under the job's control,
+    recording its status in the job registry
+    """
+    jobs.update(job_id, status=RUNNING)
+    try:
+        with span("hash"):
+            total_size, digest = size_and_digest or hash_file(input_path)
+        result = run_upscale_job(
+            input_path, uid, total_size, digest,
+            progress=lambda stage, done, total: jobs.progress(job_id, stage, done, total), **options
+        )
+        download_url, rendition_urls = output_urls(
+            base_url, result["output_name"], options["rendition_sizes"], options["packaging"]
+        )
+        jobs.update(job_id, status=DONE, result={
+            "download_url": download_url,
+            "renditions": rendition_urls,
+            "analysis": result["analysis"],
+        })
+    except HTTPException as he:
+        logger.error(f"Batch item {job_id} failed: {he.detail}")
+        jobs.update(job_id, status=FAILED, error=he.detail)
+    except JobCancelled as e:
+        logger.info(f"Batch item {job_id} stopped: {type(e).__name__}")
+        job_stopped(job_id, e)
+    except Exception as e:
+        logger.error(f"Error in batch item {job_id}: {e}", exc_info=True)
+        jobs.update(job_id, status=FAILED, error="Internal server error")
+
+def finish_batch_item(job_id: str, input_path: str, owned: bool, trace: Trace, future):
+    """
+    Clean up after a batch item, also one that never ran: cancelled while
+    queued, or dropped from the queue at shutdown
+    """
+    if future.cancelled():
+        jobs.update(job_id, status=FAILED, error="Dropped by server shutdown")
+    elif isinstance(future.exception(), JobCancelled):
+        job_stopped(job_id, future.exception())
+    else:
+        # Saved again for the profile summary, added after the item's status was final
+        jobs.save_trace(job_id, trace)
+    # Uploads belong to the job, manifest files to whoever put them there
+    if owned:
+        storage.release_input(input_path)
+        if os.path.exists(input_path):
+            os.remove(input_path)
+
+@app.post("/batch")
+async def batch_endpoint(
+    request: Request,
+    files: List[UploadFile] = File(None),
+    manifest: Optional[str] = Form(None),  # JSON list of paths under BATCH_INPUT_ROOT
+    resolution: str = Form("1920:1080"),
+    frame_rate_mode: str = Form("native"),
+    temporal: bool = Form(False),
+    renditions: Optional[str] = Form(None),
+    packaging: str = Form(MP4)
+):
+    """
+    Upscale many videos with the same settings. Videos are uploaded files
+    and/or server-side files listed in a manifest. Items are queued on the
+    job worker pool and their progress is reported by GET /batch/{id}
+    and GET /jobs/{id}.
+    """
+    if os.getenv('ENABLE_BATCH_PROCESSING', 'false').lower() != 'true':
+        raise HTTPException(status_code=404, detail="Batch processing is disabled")
+    resolution, scale, rendition_sizes = parse_upscale_options(resolution, frame_rate_mode, renditions, packaging)
+    files = files or []
+    paths = resolve_manifest(manifest) if manifest else []
+    if not files and not paths:
+        raise HTTPException(status_code=400, detail="Send files or a manifest")
+    if len(files) + len(paths) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A batch holds at most {BATCH_MAX_ITEMS} videos")
+    if any(not file.content_type.startswith('video/') for file in files):
+        raise HTTPException(status_code=400, detail="Files must be videos")
+
+    temp_dir = get_temp_dir()
+    # (source name, input path, owned by the job, uid, (size, digest) or None to hash in the worker)
+    items = []
+    try:
+        for file in files:
+            uid = str(uuid.uuid4())
+            input_path = os.path.join(temp_dir, f"{uid}_{file.filename}")
+            items.append((file.filename, input_path, True, uid, await save_upload(file, input_path)))
+            # Kept from the storage sweep however long the item waits in the queue
+            storage.hold_input(input_path)
+    except HTTPException:
+        for _, input_path, _, _, _ in items:
+            storage.release_input(input_path)
+            if os.path.exists(input_path):
+                os.remove(input_path)
+        raise
+    for path in paths:
+        items.append((os.path.relpath(path, os.path.realpath(BATCH_INPUT_ROOT)), path, False,
+                      str(uuid.uuid4()), None))
+
+    options = {
+        "scale": scale, "frame_rate_mode": frame_rate_mode, "temporal": temporal,
+        "rendition_sizes": rendition_sizes, "packaging": packaging,
+    }
+    base_url = get_base_url(request)
+    job_ids = []
+    for source, input_path, owned, uid, size_and_digest in items:
+        control = JobControl()
+        trace = Trace()
+        job_id = jobs.create("upscale", control=control, trace=trace, source=source, file_id=uid)
+        job_ids.append(job_id)
+        context = contextvars.copy_context()
+        context.run(current_trace.set, trace)
+        future = job_pool.submit(context.run, run_controlled, control, run_profiled, job_id, run_batch_item,
+                                 job_id, input_path, owned, uid, size_and_digest, base_url, options)
+        future.add_done_callback(partial(finish_batch_item, job_id, input_path, owned, trace))
+        # A cancelled item still queued leaves the queue at once
+        control.on_cancel(future.cancel)
+    batch_id = jobs.create_batch(job_ids, resolution=resolution, scale=scale, packaging=packaging)
+    logger.info(f"Queued batch {batch_id} with {len(job_ids)} videos")
+    return {
+        "batch_id": batch_id,
+        "status_url": f"{base_url}/batch/{batch_id}",
+        "jobs": job_ids,
+        "resolution": resolution,
+        "scale": scale
+    }
+
+@app.get("/batch/{batch_id}")
+async def batch_status(batch_id: str):
+    """Status of every item of a batch and the progress of the whole batch"""
+    batch = jobs.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+    return batch
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Status, stage and progress of a background job"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+@app.get("/jobs/{job_id}/trace")
+async def job_trace(job_id: str, format: str = "json"):
+    """
+    Stage spans and child processes (argv, CPU time, peak RSS) of a job.
+    format=chrome returns Chrome trace-event JSON for chrome://tracing or Perfetto.
+    """
+    trace = jobs.get_trace(job_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    if format not in ("json", "chrome"):
+        raise HTTPException(status_code=400, detail="format must be json or chrome")
+    return trace.to_chrome() if format == "chrome" else trace.to_dict()
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job, killing its processes and removing its temp data"""
+    if not jobs.cancel(job_id):
+        if jobs.get(job_id) is None:
+            raise HTTPException(status_code=404, detail="Unknown job")
+        raise HTTPException(status_code=409, detail="Job already finished")
+    return jobs.get(job_id)
+
+def run_preview_job(input_path: str, output_prefix: str, scale: str, job_key: str, samples: int,
+                    sample_duration: float, total_size: int):
+    """
+    Analyze a saved upload and upscale preview samples of it, reserving
+    storage for them; returns the analysis and the preview
+    """
+    with span("analyze"):
+        probe = probe_media(input_path)
+        analysis = analyze_video(input_path, probe)
+    # The samples, one frame each at least, are estimated like the selection of a full job
+    fps = analysis.get("fps") or 30
+    selected = samples * max(sample_duration, 1 / fps)
+    frame_format = planned_frame_format(job_key, probe, scale)
+    estimate = storage.estimate_job_bytes(analysis, int(scale), total_size, selected,
+                                          compressed_frames=FRAME_FORMATS[frame_format]["compressed"])
+    try:
+        with storage.reserve(estimate):
+            preview = preview_upscale(input_path, output_prefix, scale, job_key=job_key, probe=probe,
+                                      samples=samples, sample_duration=sample_duration)
+    except InsufficientStorage as e:
+        logger.error(f"Refusing preview: {e}")
+        raise HTTPException(status_code=507, detail="Not enough storage to preview this video, try again later")
+    if preview is None:
+        raise HTTPException(status_code=500, detail="Failed to preview video with Real-ESRGAN")
+    return analysis, preview
+
+@app.post("/preview")
+async def preview_endpoint(
+    request: Request,
+    file: UploadFile = File(...),
+    resolution: str = Form("1920:1080"),
+    samples: int = Form(3),
+    sample_duration: float = Form(0.5)  # Seconds per sample, 0 for one frame per sample
+):
+    """
+    Upscale a few short samples of a video to preview the result and project
+    the cost of the full job. Uploading the same file to /upload afterwards
+    reuses the upscaled preview frames.
+    """
+    if os.getenv('ENABLE_VIDEO_PREVIEW', 'true').lower() != 'true':
+        raise HTTPException(status_code=404, detail="Video preview is disabled")
+    if not file.content_type.startswith('video/'):
+        raise HTTPException(status_code=400, detail="File must be a video")
+    if not (1 <= samples <= 10) or not (0 <= sample_duration <= 5):
+        raise HTTPException(status_code=400, detail="samples must be 1-10 and sample_duration 0-5 seconds")
+
+    scale = resolution_to_scale(resolution)
+    uid = str(uuid.uuid4())
+    temp_dir = get_temp_dir()
+    input_path = os.path.join(temp_dir, f"{uid}_{file.filename}")
+    output_prefix = os.path.join(temp_dir, uid)
+    trace = Trace()
+    current_trace.set(trace)
+    control = JobControl()
+    job_id = jobs.create("preview", control=control, trace=trace, source=file.filename, file_id=uid)
+
+    try:
+        with span("upload"):
+            total_size, digest = await save_upload(file, input_path)
+        storage.hold_input(input_path)
+        analysis, preview = await run_job(request, partial(
+            run_preview_job, input_path, output_prefix, scale, get_job_key(digest, scale), samples, sample_duration,
+            total_size
+        ), control=control, name=job_id)
+
+        base_url = get_base_url(request)
+        files = {
+            key: f"{base_url}/videos/{os.path.basename(preview[key])}" if preview[key] else None
+            for key in ("before_path", "after_path", "clip_path")
+        }
+        jobs.update(job_id, status=DONE, result=files)
+        return {
+            "before_url": files["before_path"],
+            "after_url": files["after_path"],
+            "clip_url": files["clip_path"],
+            "analysis": analysis,
+            "resolution": resolution,
+            "scale": scale,
+            "preview_frames": preview["preview_frames"],
+            "projected": {
+                "frames": preview["total_frames"],
+                "seconds_per_frame": preview["seconds_per_frame"],
+                "upscale_seconds": preview["projected_upscale_seconds"],
+                "storage_bytes": storage.estimate_job_bytes(
+                    analysis, int(scale), total_size,
+                    compressed_frames=FRAME_FORMATS[preview["frame_format"]]["compressed"]
+                ),
+            },
+            "file_id": uid,
+            "job_id": job_id,
+            "timings": trace.timings()
+        }
+    except HTTPException as he:
+        logger.error(f"HTTPException: {he.detail}")
+        jobs.update(job_id, status=FAILED, error=he.detail)
+        raise
+    except JobCancelled as e:
+        for suffix in ("_before.png", "_after.png", "_preview.mp4"):
+            if os.path.exists(output_prefix + suffix):
+                os.remove(output_prefix + suffix)
+        raise job_stopped(job_id, e)
+    except Exception as e:
+        logger.error(f"Error in /preview: {e}", exc_info=True)
+        jobs.update(job_id, status=FAILED, error="Internal server error")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        storage.release_input(input_path)
+        if os.path.exists(input_path):
+            os.remove(input_path)
+
+def run_fix_audio(input_path: str, output_path: str, total_size: int):
+    """
+    Analyze a saved upload and remux it into output_path with an audio
+    track. Raises HTTPException when it cannot; returns the analysis and the
+    remux plan.
+    """
+    probe = probe_media(input_path)
+    analysis = analyze_video(input_path, probe)
+    logger.info(f"Video analysis: {analysis}")
+    plan = plan_remux(probe)
+    if plan["noop"]:
+        # Already an MP4 with audio, hand back the original untouched
+        logger.info(f"No audio fix needed for {input_path}")
+        os.replace(input_path, output_path)
+        return analysis, plan
+    cmd = remux_command(plan, input_path, output_path)
+    logger.info(f"Running audio fix command: {' '.join(cmd)}")
+    try:
+        # The fixed copy is about as large as the upload
+        with storage.reserve(total_size, output_path=output_path):
+            result = run_process(cmd)
+    except InsufficientStorage as e:
+        logger.error(f"Refusing job: {e}")
+        raise HTTPException(status_code=507, detail="Not enough storage to process this video, try again later")
+    if result.returncode != 0:
+        logger.error(f"FFmpeg error: {result.stderr}")
+        raise HTTPException(status_code=500, detail="Failed to fix audio")
+    return analysis, plan
 
 @app.post("/fix-audio")
 async def fix_audio_endpoint(request: Request, file: UploadFile = File(...)):
@@ -163,36 +841,11 @@ async def fix_audio_endpoint(request: Request, file: UploadFile = File(...)):
     input_path = os.path.join(temp_dir, f"{uid}_{file.filename}")
     output_path = os.path.join(temp_dir, f"{uid}_audiofixed.mp4")
     try:
-        # Save uploaded file and check size (optimized for memory)
-        total_size = 0
-        with open(input_path, "wb") as f:
-            while True:
-                chunk = await file.read(1024 * 1024)  # 1MB chunks
-                if not chunk:
-                    break
-                total_size += len(chunk)
-                if total_size > 100 * 1024 * 1024:
-                    f.close()
-                    os.remove(input_path)
-                    raise HTTPException(status_code=400, detail="File size must be less than 100MB")
-                f.write(chunk)
-        logger.info(f"Saved uploaded file to {input_path}")
-        analysis = analyze_video(input_path)
-        logger.info(f"Video analysis: {analysis}")
-        if analysis.get('has_audio'):
-            cmd = [
-                "ffmpeg", "-i", input_path, "-c", "copy", "-y", output_path
-            ]
-        else:
-            cmd = [
-                "ffmpeg", "-i", input_path, "-f", "lavfi", "-i", "anullsrc=channel_layout=stereo:sample_rate=44100",
-                "-shortest", "-c:v", "copy", "-c:a", "aac", "-b:a", "128k", "-y", output_path
-            ]
-        logger.info(f"Running audio fix command: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            logger.error(f"FFmpeg error: {result.stderr}")
-            raise HTTPException(status_code=500, detail="Failed to fix audio")
+        total_size, _ = await save_upload(file, input_path)
+        storage.hold_input(input_path)
+        # A remux is short, it does not wait for an upscale worker
+        analysis, plan = await run_job(request, partial(run_fix_audio, input_path, output_path, total_size),
+                                       executor=None)
         if os.path.exists(input_path):
             os.remove(input_path)
         base_url = get_base_url(request)
@@ -200,6 +853,7 @@ async def fix_audio_endpoint(request: Request, file: UploadFile = File(...)):
         return {
             "download_url": download_url,
             "analysis": analysis,
+            "remux_plan": plan,
             "file_id": uid
         }
     except HTTPException as he:
@@ -208,23 +862,43 @@ async def fix_audio_endpoint(request: Request, file: UploadFile = File(...)):
             if os.path.exists(path):
                 os.remove(path)
         raise
+    except JobCancelled as e:
+        for path in [input_path, output_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise job_stopped(None, e)
     except Exception as e:
         for path in [input_path, output_path]:
             if os.path.exists(path):
                 os.remove(path)
         logger.error(f"Error fixing audio: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        storage.release_input(input_path)
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    return {"status": "healthy", "service": "gold-star-evolution-enhancer"}
+    """
+    Health check endpoint with the tools and models found at startup; 503
+    while draining, or when a missing tool would fail every job
+    """
+    capabilities = await asyncio.to_thread(get_capabilities)
+    if draining.is_set():
+        status = "draining"
+    else:
+        status = "healthy" if capabilities["ready"] else "unhealthy"
+    content = {"status": status, "service": "gold-star-evolution-enhancer", "capabilities": capabilities}
+    return JSONResponse(status_code=200 if status == "healthy" else 503, content=content)
+
+@app.get("/storage")
+async def storage_status():
+    """Disk usage of uploads, work dirs and outputs against the storage budget"""
+    return await asyncio.to_thread(storage.usage)
 
 @app.get("/")
 def root():
     return {"message": "Gold Star Evolution Enhancer backend is running."}
 
 if __name__ == "__main__":
-    import uvicorn
-    port = int(os.environ.get("PORT", 10000))
-    uvicorn.run("app:app", host="0.0.0.0", port=port) 
\ No newline at end of file
+    from serve import main
+    main() 
\ No newline at end of file
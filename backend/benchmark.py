@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Benchmark the intermediate frame formats on a sample video.
+
+For every format in FRAME_FORMATS this extracts the frames the way the
+upscale pipeline does, then decodes them back the way the upscaler and the
+reassembly read them, and reports time and disk cost per frame.
+
+Usage: python benchmark.py sample.mp4 [work_root]
+"""
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+import uuid
+
+from video_processing import FRAME_FORMATS, extract_frames, get_temp_dir, measure_write_speed
+
+
+def decode_frames(frames_dir, ext):
+    """Read every frame back through ffmpeg, discarding the pixels"""
+    cmd = [
+        "ffmpeg", "-v", "error", "-i", os.path.join(frames_dir, f"frame_%06d.{ext}"),
+        "-f", "null", "-"
+    ]
+    start = time.perf_counter()
+    subprocess.run(cmd, capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def benchmark_format(input_path, frame_format, root):
+    frames_dir = os.path.join(root, f"realesrgan_bench_{uuid.uuid4()}")
+    os.makedirs(frames_dir)
+    try:
+        start = time.perf_counter()
+        if extract_frames(input_path, frames_dir, frame_format) is None:
+            raise RuntimeError(f"Extraction failed for {frame_format}")
+        extract_time = time.perf_counter() - start
+        files = os.listdir(frames_dir)
+        size = sum(os.path.getsize(os.path.join(frames_dir, f)) for f in files)
+        decode_time = decode_frames(frames_dir, FRAME_FORMATS[frame_format]["ext"])
+        return len(files), extract_time, decode_time, size
+    finally:
+        shutil.rmtree(frames_dir, ignore_errors=True)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    input_path = sys.argv[1]
+    root = sys.argv[2] if len(sys.argv) > 2 else get_temp_dir()
+
+    print(f"Work root: {root} (write speed {measure_write_speed(root):.0f} MB/s)")
+    print(f"{'format':<8}{'frames':>8}{'extract ms/f':>14}{'decode ms/f':>13}{'KB/frame':>10}")
+    for frame_format in FRAME_FORMATS:
+        frames, extract_time, decode_time, size = benchmark_format(input_path, frame_format, root)
+        if not frames:
+            print(f"{frame_format:<8}{0:>8}")
+            continue
+        print(
+            f"{frame_format:<8}{frames:>8}"
+            f"{extract_time / frames * 1000:>14.2f}"
+            f"{decode_time / frames * 1000:>13.2f}"
+            f"{size / frames / 1024:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
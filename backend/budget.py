@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Learned cost of each stage in seconds per megapixel of frames it handles
+# (source pixels for extract, upscaled pixels for upscale and reassemble),
+# kept as an exponentially weighted moving average across jobs
+COST_MODEL_FILE = os.getenv('COST_MODEL_FILE', os.path.join(tempfile.gettempdir(), "upscale_costs.json"))
+DEFAULT_COSTS = {"extract": 0.05, "upscale": 2.0, "reassemble": 0.1}
+COST_SMOOTHING = 0.3  # Weight of the latest job in the moving average
+BUDGET_SAFETY = float(os.getenv('BUDGET_SAFETY', 3.0))  # Budget this many times the expected time
+MIN_STAGE_SECONDS = float(os.getenv('MIN_STAGE_SECONDS', 30))  # Fixed overhead allowed to every stage
+MIN_PROGRESS = 0.1  # Share of a stage done before its rate is trusted to predict an overrun
+# Stage allowance of jobs the probe could not size: (fixed seconds, seconds per frame)
+FALLBACK_SECONDS = {"extract": (300, 0), "upscale": (0, 60), "reassemble": (600, 0)}
+
+_model_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a job has missed, or is clearly going to miss, its deadline"""
+
+
+def load_costs() -> dict:
+    costs = dict(DEFAULT_COSTS)
+    try:
+        with open(COST_MODEL_FILE) as f:
+            costs.update({stage: float(cost) for stage, cost in json.load(f).items() if stage in costs})
+    except (OSError, ValueError, TypeError, AttributeError):
+        pass
+    return costs
+
+
+def record_cost(stage: str, seconds_per_megapixel: float):
+    """Fold a measured stage cost into the persisted cost model"""
+    with _model_lock:
+        costs = load_costs()
+        costs[stage] += COST_SMOOTHING * (seconds_per_megapixel - costs[stage])
+        path = f"{COST_MODEL_FILE}.{os.getpid()}.tmp"
+        try:
+            with open(path, "w") as f:
+                json.dump(costs, f)
+            os.replace(path, COST_MODEL_FILE)
+        except OSError as e:
+            logger.warning(f"Could not save cost model: {e}")
+
+
+class JobBudget:
+    """
+    Deadline budget of one job. Every stage gets the time the cost model
+    expects for its frames, BUDGET_SAFETY times over plus MIN_STAGE_SECONDS,
+    and time a stage leaves unused carries over to the next ones.
+    Subprocess timeouts come from the stage deadline, stages report their
+    progress with advance(), and the measured costs of finished stages
+    train the cost model.
+
+    A job of unknown frame size (width or height 0) cannot be budgeted; its
+    stages get the fixed FALLBACK_SECONDS and do not train the cost model.
+    """
+
+    def __init__(self, width: int, height: int, scale):
+        self.fallback = not (width and height)
+        self.source_megapixels = max(width * height, 1) / 1e6
+        self.output_megapixels = self.source_megapixels * int(scale) ** 2
+        self.costs = load_costs()
+        self.deadline = None  # Of the current stage
+        self.stages = {}
+
+    def _megapixels(self, stage: str) -> float:
+        return self.source_megapixels if stage == "extract" else self.output_megapixels
+
+    def expected(self, stage: str, frames: int) -> float:
+        """Seconds the cost model expects a stage to take for this many frames"""
+        return self.costs[stage] * frames * self._megapixels(stage)
+
+    def allowance(self, stage: str, frames: int) -> float:
+        """Seconds a stage is given for this many frames, before slack from earlier stages"""
+        if self.fallback:
+            fixed, per_frame = FALLBACK_SECONDS[stage]
+            return fixed + per_frame * frames
+        return self.expected(stage, frames) * BUDGET_SAFETY + MIN_STAGE_SECONDS
+
+    def job_allowance(self, frames: int) -> float:
+        """Seconds the whole job is given, for work running alongside the stages"""
+        return sum(self.allowance(stage, frames) for stage in self.costs)
+
+    def start(self, stage: str, frames: int):
+        """Start the budget of a stage that handles this many frames"""
+        now = time.monotonic()
+        self.stages[stage] = {"started": now, "frames": frames, "done": 0, "rate": None}
+        allowance = self.allowance(stage, frames)
+        slack = max(self.deadline - now, 0.0) if self.deadline is not None else 0.0
+        self.deadline = now + allowance + slack
+        logger.info(f"Budget for {stage} of {frames} frames: {allowance + slack:.0f}s")
+
+    def timeout(self) -> float:
+        """Seconds left before the current stage's deadline, for subprocess timeouts"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 1.0)
+
+    def check(self):
+        """Raise DeadlineExceeded if the current stage is past its deadline"""
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise DeadlineExceeded("Job overran its budget")
+
+    def advance(self, stage: str, done: int):
+        """
+        Record that `done` frames of a stage are finished. Raises
+        DeadlineExceeded when the stage's rate shows it will miss its deadline.
+        """
+        info = self.stages[stage]
+        now = time.monotonic()
+        elapsed = now - info["started"]
+        info["done"] = done
+        info["rate"] = done / elapsed if elapsed > 0 else None
+        if self.deadline is None:
+            return
+        if now > self.deadline:
+            raise DeadlineExceeded(f"{stage} overran its budget after {done}/{info['frames']} frames")
+        if info["frames"] and done / info["frames"] >= MIN_PROGRESS and info["rate"]:
+            projected = info["started"] + info["frames"] / info["rate"]
+            if projected > self.deadline:
+                raise DeadlineExceeded(
+                    f"{stage} at {info['rate']:.2f} frames/s would take {projected - info['started']:.0f}s, "
+                    f"{projected - self.deadline:.0f}s over budget"
+                )
+
+    def finish(self, stage: str, frames: int = None, measured: tuple = None):
+        """
+        Close a stage and learn its cost per megapixel. frames corrects the
+        count given to start(). measured, (seconds, frames), learns the cost
+        from that part of the work instead of the whole stage, e.g. from the
+        model runs alone when cached or warped frames took almost no time.
+        """
+        info = self.stages[stage]
+        if frames is not None:
+            info["frames"] = frames
+        elapsed = time.monotonic() - info["started"]
+        info["done"] = info["frames"]
+        info["rate"] = info["frames"] / elapsed if elapsed > 0 else None
+        seconds, learned_frames = measured if measured is not None else (elapsed, info["frames"])
+        if learned_frames and not self.fallback:
+            record_cost(stage, seconds / (learned_frames * self._megapixels(stage)))
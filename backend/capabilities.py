@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+from video_processing import REALESRGAN_BIN, REALESRGAN_MODEL
+from supervisor import run_process
+
+logger = logging.getLogger(__name__)
+
+# What the tools on this host can do, saved between restarts and rescanned
+# only when a binary or the model dir changes (by path, mtime and size)
+CAPABILITY_CACHE = os.getenv('CAPABILITY_CACHE', os.path.join(tempfile.gettempdir(), "upscale_capabilities.json"))
+SCAN_TIMEOUT = 30
+
+# Without these no job can finish
+REQUIRED_ENCODERS = ("libx264", "aac")
+REQUIRED_FILTERS = ("showinfo", "fps", "framerate", "scale", "split", "format", "atrim", "asetpts", "concat",
+                    "anullsrc")
+# Without these a feature is unavailable: HLS and DASH packaging of renditions
+OPTIONAL_MUXERS = ("hls", "dash")
+
+_capabilities = None
+
+
+def _fingerprint(path: str):
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{path}:{st.st_mtime_ns}:{st.st_size}"
+
+
+def _model_dirs(upscaler_path: str) -> list:
+    """Where Real-ESRGAN looks for models: next to its binary, and the working dir"""
+    dirs = [os.path.join(os.getcwd(), "models")]
+    if upscaler_path:
+        dirs.insert(0, os.path.join(os.path.dirname(os.path.realpath(upscaler_path)), "models"))
+    return [path for path in dict.fromkeys(dirs) if os.path.isdir(path)]
+
+
+def _ffmpeg_list(ffmpeg: str, option: str) -> set:
+    """Names in an `ffmpeg -encoders` / `-filters` / `-muxers` listing"""
+    result = run_process([ffmpeg, "-hide_banner", option], timeout=SCAN_TIMEOUT)
+    names = set()
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        # Entries are indented "<flags> <name> ..."; legend lines read "<flags> = <meaning>"
+        if line.startswith(" ") and len(fields) >= 2 and fields[1] != "=":
+            names.update(fields[1].split(","))
+    return names
+
+
+def _scan_ffmpeg(path: str) -> dict:
+    if not path:
+        return {"path": None}
+    version = run_process([path, "-hide_banner", "-version"], timeout=SCAN_TIMEOUT).stdout.split("\n", 1)[0]
+    encoders = _ffmpeg_list(path, "-encoders")
+    filters = _ffmpeg_list(path, "-filters")
+    muxers = _ffmpeg_list(path, "-muxers")
+    return {
+        "path": path,
+        "version": version.split()[2] if version.startswith("ffmpeg version") else version,
+        "encoders": {name: name in encoders for name in REQUIRED_ENCODERS},
+        "filters": {name: name in filters for name in REQUIRED_FILTERS},
+        "muxers": {name: name in muxers for name in OPTIONAL_MUXERS},
+        "hardware_encoders": sorted(name for name in encoders if name.endswith(("_nvenc", "_qsv", "_vaapi", "_amf"))),
+    }
+
+
+def _scan_upscaler(path: str) -> dict:
+    models = set()
+    for directory in _model_dirs(path):
+        models.update(os.path.splitext(name)[0] for name in os.listdir(directory) if name.endswith(".param"))
+    return {"path": path, "models": sorted(models)}
+
+
+def _problems(found: dict) -> tuple:
+    """(errors that stop every job, warnings about degraded features)"""
+    errors, warnings = [], []
+    ffmpeg = found["ffmpeg"]
+    if not ffmpeg["path"]:
+        errors.append("ffmpeg not found")
+    elif "error" in ffmpeg:
+        errors.append(f"ffmpeg does not run: {ffmpeg['error']}")
+    else:
+        errors.extend(f"ffmpeg lacks the {name} encoder" for name, ok in ffmpeg["encoders"].items() if not ok)
+        errors.extend(f"ffmpeg lacks the {name} filter" for name, ok in ffmpeg["filters"].items() if not ok)
+        warnings.extend(f"ffmpeg lacks the {name} muxer" for name, ok in ffmpeg["muxers"].items() if not ok)
+    if not found["ffprobe"]["path"]:
+        warnings.append("ffprobe not found, videos are processed without metadata")
+    upscaler = found["upscaler"]
+    if not upscaler["path"]:
+        errors.append(f"{REALESRGAN_BIN} not found")
+    elif REALESRGAN_MODEL not in upscaler["models"]:
+        searched = _model_dirs(upscaler["path"]) or "models/"
+        errors.append(f"Real-ESRGAN model {REALESRGAN_MODEL} not found in {searched}")
+    return errors, warnings
+
+
+def scan_capabilities() -> dict:
+    """
+    Find ffmpeg, ffprobe and Real-ESRGAN with the encoders, filters, muxers
+    and models the pipeline uses. The result is cached on disk and reused
+    while the binaries and model dirs are unchanged.
+    """
+    paths = {"ffmpeg": shutil.which("ffmpeg"), "ffprobe": shutil.which("ffprobe"),
+             "upscaler": shutil.which(REALESRGAN_BIN)}
+    key = {name: _fingerprint(path) for name, path in paths.items()}
+    key["models"] = [_fingerprint(path) for path in _model_dirs(paths["upscaler"])]
+    try:
+        with open(CAPABILITY_CACHE) as f:
+            cached = json.load(f)
+        if cached.get("key") == key:
+            return cached["capabilities"]
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    started = time.perf_counter()
+    try:
+        ffmpeg = _scan_ffmpeg(paths["ffmpeg"])
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error(f"Could not scan ffmpeg at {paths['ffmpeg']}: {e}")
+        ffmpeg = {"path": paths["ffmpeg"], "error": str(e)}
+    found = {
+        "ffmpeg": ffmpeg,
+        "ffprobe": {"path": paths["ffprobe"]},
+        "upscaler": _scan_upscaler(paths["upscaler"]),
+    }
+    errors, warnings = _problems(found)
+    capabilities = {**found, "ready": not errors, "errors": errors, "warnings": warnings,
+                    "scanned": time.time(), "scan_seconds": round(time.perf_counter() - started, 3)}
+    if "error" in ffmpeg:
+        return capabilities  # Scan again next time
+    path = f"{CAPABILITY_CACHE}.{os.getpid()}.tmp"
+    try:
+        with open(path, "w") as f:
+            json.dump({"key": key, "capabilities": capabilities}, f)
+        os.replace(path, CAPABILITY_CACHE)
+    except OSError as e:
+        logger.warning(f"Could not save capability cache: {e}")
+    return capabilities
+
+
+def get_capabilities(refresh: bool = False) -> dict:
+    """Capabilities found at startup, scanned now if they were not yet"""
+    global _capabilities
+    if _capabilities is None or refresh:
+        _capabilities = scan_capabilities()
+    return _capabilities
@@ -67,6 +67,13 @@ class Config:
         self.ENABLE_VIDEO_PREVIEW = os.getenv('ENABLE_VIDEO_PREVIEW', 'true').lower() == 'true'
         self.ENABLE_BATCH_PROCESSING = os.getenv('ENABLE_BATCH_PROCESSING', 'false').lower() == 'true'
         
+        # Resource Tuning (0 = derive from the host's CPUs, memory and temp space, see resources.py)
+        self.JOB_WORKERS = int(os.getenv('JOB_WORKERS') or 0)
+        self.FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS') or 0)
+        self.FFMPEG_FILTER_THREADS = int(os.getenv('FFMPEG_FILTER_THREADS') or 0)
+        self.UPSCALE_TILE_SIZE = int(os.getenv('UPSCALE_TILE_SIZE') or 0)
+        self.UPSCALE_IO_THREADS = int(os.getenv('UPSCALE_IO_THREADS') or 0)
+        
         # Custom Configuration
         self.CUSTOM_FFMPEG_ARGS = os.getenv('CUSTOM_FFMPEG_ARGS', '').split() if os.getenv('CUSTOM_FFMPEG_ARGS') else []
         self.CUSTOM_REALESRGAN_ARGS = os.getenv('CUSTOM_REALESRGAN_ARGS', '').split() if os.getenv('CUSTOM_REALESRGAN_ARGS') else []
@@ -108,12 +115,13 @@ class Config:
             if factor not in [2, 4]:
                 errors.append(f"VIDEO_SCALE_FACTORS must be 2 or 4, got {factor}")
         
-        # Validate paths
+        # Validate paths; missing tools are reported by the capability scan
+        # and /health rather than failing the import
         if not os.path.exists(self.FFMPEG_PATH):
-            errors.append(f"FFMPEG_PATH does not exist: {self.FFMPEG_PATH}")
+            logger.warning(f"FFMPEG_PATH does not exist: {self.FFMPEG_PATH}")
         
         if not os.path.exists(self.REALESRGAN_PATH):
-            errors.append(f"REALESRGAN_PATH does not exist: {self.REALESRGAN_PATH}")
+            logger.warning(f"REALESRGAN_PATH does not exist: {self.REALESRGAN_PATH}")
         
         # Validate directories
         for dir_path in [self.UPLOAD_DIR, self.TEMP_DIR]:
@@ -131,6 +139,11 @@ class Config:
         if self.RATE_LIMIT_WINDOW <= 0:
             errors.append(f"RATE_LIMIT_WINDOW must be positive, got {self.RATE_LIMIT_WINDOW}")
         
+        # Validate resource tuning overrides
+        for name in ('JOB_WORKERS', 'FFMPEG_THREADS', 'FFMPEG_FILTER_THREADS', 'UPSCALE_TILE_SIZE', 'UPSCALE_IO_THREADS'):
+            if getattr(self, name) < 0:
+                errors.append(f"{name} must be 0 (derive from the host) or positive, got {getattr(self, name)}")
+        
         # Report errors
         if errors:
             error_msg = "Configuration validation failed:\n" + "\n".join(f"  • {error}" for error in errors)
@@ -248,6 +261,11 @@ class Config:
             "ENABLE_AUDIO_ANALYSIS": self.ENABLE_AUDIO_ANALYSIS,
             "ENABLE_VIDEO_PREVIEW": self.ENABLE_VIDEO_PREVIEW,
             "ENABLE_BATCH_PROCESSING": self.ENABLE_BATCH_PROCESSING,
+            "JOB_WORKERS": self.JOB_WORKERS,
+            "FFMPEG_THREADS": self.FFMPEG_THREADS,
+            "FFMPEG_FILTER_THREADS": self.FFMPEG_FILTER_THREADS,
+            "UPSCALE_TILE_SIZE": self.UPSCALE_TILE_SIZE,
+            "UPSCALE_IO_THREADS": self.UPSCALE_IO_THREADS,
             "CUSTOM_FFMPEG_ARGS": self.CUSTOM_FFMPEG_ARGS,
             "CUSTOM_REALESRGAN_ARGS": self.CUSTOM_REALESRGAN_ARGS,
         }
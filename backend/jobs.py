@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import sqlite3
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager, closing
+
+from tracing import Trace
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Share of a job's progress each pipeline stage accounts for
+STAGE_WEIGHTS = {"extract": 0.1, "upscale": 0.8, "reassemble": 0.1}
+JOB_HISTORY_TTL = int(os.getenv('JOB_HISTORY_TTL', 24 * 3600))  # Finished jobs are forgotten after this
+# Job status shared by the server's worker processes. serve.py points every
+# worker of one launch at the same file; a lone process gets its own, which
+# it removes on exit.
+JOB_DB = os.getenv('JOB_DB') or os.path.join(tempfile.gettempdir(), f"upscale_jobs_{os.getpid()}.sqlite3")
+_OWN_JOB_DB = None if os.getenv('JOB_DB') else os.getpid()
+CANCEL_POLL = 1.0  # Seconds between checks for jobs cancelled through another process
+TRACE_SAVE_INTERVAL = 5.0  # Seconds between saves of a running job's trace for other processes
+
+
+def remove_job_db(path: str):
+    """Remove a job database with its sqlite journal files"""
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+
+@atexit.register
+def _remove_own_job_db():
+    # Forked workers inherit this handler, only the process that made the file removes it
+    if _OWN_JOB_DB == os.getpid():
+        remove_job_db(JOB_DB)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY, status TEXT, updated REAL, cancellable INTEGER, job TEXT, trace TEXT
+);
+CREATE TABLE IF NOT EXISTS batches (id TEXT PRIMARY KEY, batch TEXT);
+"""
+
+
+class JobRegistry:
+    """
+    Status of background jobs and the batches grouping them, in a sqlite
+    file shared by the server's worker processes, so any of them answers
+    for any job. Jobs move from queued to running to done or failed, and
+    report progress per pipeline stage. Jobs created with a JobControl can
+    be cancelled until they finish, from any process: the process running
+    the job sees the cancelled status within CANCEL_POLL seconds and stops
+    it. A finished job's status no longer changes.
+    A job's Trace, if it has one, is saved alongside it.
+    """
+
+    def __init__(self, path: str = JOB_DB):
+        self.path = path
+        # Jobs running in this process
+        self._controls = {}
+        self._traces = {}
+        self._trace_saved = {}
+        self._lock = threading.Lock()
+        self._watcher_pid = None
+        with closing(self._connect()) as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    @contextmanager
+    def _db(self):
+        """A connection in a transaction; connections are not shared across threads or forks"""
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    @staticmethod
+    def _load(db, job_id: str):
+        row = db.execute("SELECT job FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def create(self, kind: str, control=None, trace=None, **info) -> str:
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        job = {
+            "id": job_id,
+            "kind": kind,
+            "status": QUEUED,
+            "stage": None,
+            "stage_rate": None,  # Units of the current stage finished per second
+            "stage_eta": None,  # Seconds until the current stage is done, at that rate
+            "progress": 0.0,
+            "created": now,
+            "updated": now,
+            "result": None,
+            "error": None,
+            **info,
+        }
+        with self._db() as db:
+            self._prune(db, now)
+            db.execute(
+                "INSERT INTO jobs (id, status, updated, cancellable, job, trace) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, now, control is not None, json.dumps(job),
+                 json.dumps(trace.to_dict()) if trace is not None else None),
+            )
+        with self._lock:
+            if control is not None:
+                self._controls[job_id] = control
+            if trace is not None:
+                self._traces[job_id] = trace
+                self._trace_saved[job_id] = now
+        if control is not None:
+            self._start_watcher()
+        return job_id
+
+    def _save(self, db, job: dict):
+        db.execute("UPDATE jobs SET status = ?, updated = ?, job = ? WHERE id = ?",
+                   (job["status"], job["updated"], json.dumps(job), job["id"]))
+
+    def _finished(self, job_id: str):
+        """Drop what this process kept of a job that finished, after saving its trace"""
+        self.save_trace(job_id)
+        with self._lock:
+            self._controls.pop(job_id, None)
+            self._traces.pop(job_id, None)
+            self._trace_saved.pop(job_id, None)
+
+    def update(self, job_id: str, **fields):
+        with self._db() as db:
+            job = self._load(db, job_id)
+            if job is None or job["status"] in FINISHED:
+                return
+            job.update(fields, updated=time.time())
+            if job["status"] == DONE:
+                job["progress"] = 1.0
+            self._save(db, job)
+        if job["status"] in FINISHED:
+            self._finished(job_id)
+        elif time.time() - self._trace_saved.get(job_id, float("inf")) > TRACE_SAVE_INTERVAL:
+            self.save_trace(job_id)
+
+    def progress(self, job_id: str, stage: str, done: int, total: int):
+        """Record that `done` of `total` units of a pipeline stage are finished"""
+        completed = 0.0
+        for name, weight in STAGE_WEIGHTS.items():
+            if name == stage:
+                completed += weight * (done / total if total else 1.0)
+                break
+            completed += weight
+        now = time.time()
+        with self._db() as db:
+            job = self._load(db, job_id)
+            if job is None or job["status"] in FINISHED:
+                return
+            if job["stage"] != stage:
+                job["stage_started"] = (now, done)
+            started, done_at_start = job["stage_started"]
+            rate = eta = None
+            if now > started and done > done_at_start:
+                rate = (done - done_at_start) / (now - started)
+                eta = round((total - done) / rate, 1)
+                rate = round(rate, 3)
+            job.update(status=RUNNING, stage=stage, progress=round(completed, 4), stage_rate=rate, stage_eta=eta,
+                       updated=now)
+            self._save(db, job)
+        if now - self._trace_saved.get(job_id, float("inf")) > TRACE_SAVE_INTERVAL:
+            self.save_trace(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job; False if it is unknown, finished or not cancellable"""
+        with self._db() as db:
+            row = db.execute("SELECT cancellable FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            job = self._load(db, job_id)
+            if job is None or not row[0] or job["status"] in FINISHED:
+                return False
+            job.update(status=CANCELLED, updated=time.time())
+            self._save(db, job)
+        # A job of another process is stopped by that process's watcher
+        with self._lock:
+            control = self._controls.get(job_id)
+        if control is not None:
+            control.cancel()
+            self._finished(job_id)
+        return True
+
+    def _start_watcher(self):
+        """Watch for cancels made through other processes; once per process, also after a fork"""
+        with self._lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+        threading.Thread(target=self._watch, name="job-cancel-watcher", daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(CANCEL_POLL)
+            with self._lock:
+                job_ids = list(self._controls)
+            if not job_ids:
+                continue
+            try:
+                with self._db() as db:
+                    rows = db.execute(
+                        f"SELECT id, status FROM jobs WHERE id IN ({','.join('?' * len(job_ids))})", job_ids
+                    ).fetchall()
+            except sqlite3.Error as e:
+                logger.warning(f"Could not check for cancelled jobs: {e}")
+                continue
+            for job_id, status in rows:
+                if status == CANCELLED:
+                    with self._lock:
+                        control = self._controls.get(job_id)
+                    if control is not None:
+                        logger.info(f"Job {job_id} was cancelled through another process")
+                        control.cancel()
+                        self._finished(job_id)
+
+    def save_trace(self, job_id: str, trace: Trace = None):
+        """
+        Save the trace of a job running in this process for the other
+        processes, or `trace` for one completed after the job finished
+        """
+        with self._lock:
+            trace = trace or self._traces.get(job_id)
+            if trace is None:
+                return
+            self._trace_saved[job_id] = time.time()
+        with self._db() as db:
+            db.execute("UPDATE jobs SET trace = ? WHERE id = ?", (json.dumps(trace.to_dict()), job_id))
+
+    def get_trace(self, job_id: str):
+        with self._lock:
+            trace = self._traces.get(job_id)
+        if trace is not None:
+            return trace
+        with self._db() as db:
+            row = db.execute("SELECT trace FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Trace.from_dict(json.loads(row[0])) if row and row[0] else None
+
+    def get(self, job_id: str) -> dict:
+        with self._db() as db:
+            return self._load(db, job_id)
+
+    def create_batch(self, job_ids: list, **info) -> str:
+        batch_id = str(uuid.uuid4())
+        batch = {"id": batch_id, "jobs": list(job_ids), "created": time.time(), **info}
+        with self._db() as db:
+            db.execute("INSERT INTO batches (id, batch) VALUES (?, ?)", (batch_id, json.dumps(batch)))
+        return batch_id
+
+    def get_batch(self, batch_id: str) -> dict:
+        """A batch with the status of every item and its aggregate progress"""
+        with self._db() as db:
+            row = db.execute("SELECT batch FROM batches WHERE id = ?", (batch_id,)).fetchone()
+            if row is None:
+                return None
+            batch = json.loads(row[0])
+            items = [job for job in (self._load(db, job_id) for job_id in batch["jobs"]) if job is not None]
+        counts = {status: 0 for status in (QUEUED, RUNNING, *FINISHED)}
+        for item in items:
+            counts[item["status"]] += 1
+        finished = sum(counts[status] for status in FINISHED) == len(items)
+        return {
+            **batch,
+            "status": DONE if finished else RUNNING,
+            "progress": round(sum(item["progress"] for item in items) / len(items), 4) if items else 1.0,
+            "counts": counts,
+            "items": items,
+        }
+
+    def _prune(self, db, now: float):
+        db.execute(f"DELETE FROM jobs WHERE status IN ({','.join('?' * len(FINISHED))}) AND updated < ?",
+                   (*FINISHED, now - JOB_HISTORY_TTL))
+        for batch_id, batch in db.execute("SELECT id, batch FROM batches").fetchall():
+            job_ids = json.loads(batch)["jobs"]
+            remaining = db.execute(f"SELECT COUNT(*) FROM jobs WHERE id IN ({','.join('?' * len(job_ids))})",
+                                   job_ids).fetchone()[0]
+            if not remaining:
+                db.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
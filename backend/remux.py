@@ -0,0 +1,130 @@
+import logging
+from resources import ffmpeg_thread_args
+
+logger = logging.getLogger(__name__)
+
+# Codecs that can be stream-copied into an MP4 container as they are
+MP4_VIDEO_CODECS = {"h264", "hevc", "av1", "mpeg4", "vp9"}
+MP4_AUDIO_CODECS = {"aac", "mp3", "ac3", "eac3", "alac", "opus", "flac"}
+
+# Settings used whenever audio has to be (re)encoded or synthesised
+AUDIO_ARGS = ["-c:a", "aac", "-b:a", "128k"]
+SILENCE_SOURCE = "anullsrc=channel_layout=stereo:sample_rate=44100"
+
+COPY = "copy"
+TRANSCODE = "transcode"
+SILENCE = "silence"
+
+
+def _first_stream(probe: dict, codec_type: str) -> dict:
+    for stream in probe.get("streams", []):
+        if stream.get("codec_type") == codec_type:
+            return stream
+    return {}
+
+
+def is_mp4(probe: dict) -> bool:
+    """Check if the probed file already is an MP4 (and not a QuickTime .mov)"""
+    fmt = probe.get("format", {})
+    brand = fmt.get("tags", {}).get("major_brand", "").strip()
+    return "mp4" in fmt.get("format_name", "").split(",") and brand != "qt"
+
+
+def plan_remux(probe: dict) -> dict:
+    """
+    Decide per stream how to get a probed file into an MP4 with audio:
+    copy what the container accepts, transcode what it does not and
+    synthesise a silent track when there is no audio. When nothing needs to
+    change the plan is a no-op and the original file can be used as is.
+    """
+    video = _first_stream(probe, "video")
+    audio = _first_stream(probe, "audio")
+
+    probed = bool(probe.get("streams"))
+    plan = {
+        "video": COPY if video.get("codec_name") in MP4_VIDEO_CODECS else TRANSCODE,
+        "audio": SILENCE,
+        "audio_codec": audio.get("codec_name"),
+        "probed": probed,
+    }
+    if audio:
+        plan["audio"] = COPY if audio.get("codec_name") in MP4_AUDIO_CODECS else TRANSCODE
+    elif not probed:
+        # Without a probe copy the video and transcode whatever audio is there
+        plan["video"] = COPY
+        plan["audio"] = TRANSCODE
+    plan["noop"] = is_mp4(probe) and plan["video"] == COPY and plan["audio"] == COPY
+    logger.info(f"Remux plan: {plan}")
+    return plan
+
+
+def audio_input_args(plan: dict, source_path: str) -> list:
+    """ffmpeg input args that provide the audio of a plan"""
+    if plan["audio"] == SILENCE:
+        return ["-f", "lavfi", "-i", SILENCE_SOURCE]
+    return ["-i", source_path]
+
+
+def audio_output_args(plan: dict, audio_input: int) -> list:
+    """ffmpeg map and codec args for the audio of a plan read from input `audio_input`"""
+    # An unprobed source may have no audio at all, so its audio map is optional
+    args = ["-map", f"{audio_input}:a:0" + ("" if plan["probed"] else "?")]
+    if plan["audio"] == COPY:
+        args.extend(["-c:a", "copy"])
+    else:
+        args.extend(AUDIO_ARGS)
+    if plan["audio"] == SILENCE:
+        # The silent source is endless, stop at the end of the video
+        args.append("-shortest")
+    return args
+
+
+def remux_command(plan: dict, input_path: str, output_path: str) -> list:
+    """Build the ffmpeg command applying a plan to a file, keeping its video"""
+    cmd = ["ffmpeg", "-i", input_path]
+    audio_input = 0
+    if plan["audio"] == SILENCE:
+        cmd.extend(audio_input_args(plan, input_path))
+        audio_input = 1
+    cmd.extend(["-map", "0:v:0"])
+    cmd.extend(["-c:v", "copy"] if plan["video"] == COPY else ["-c:v", "libx264", "-crf", "18", *ffmpeg_thread_args()])
+    cmd.extend(audio_output_args(plan, audio_input))
+    cmd.extend(["-movflags", "+faststart", "-y", output_path])
+    return cmd
+
+
+def trim_audio_filter(ranges: list) -> str:
+    """filter_complex cutting [start, end] second ranges out of the first audio stream into [aout]"""
+    parts = []
+    for i, (start, end) in enumerate(ranges):
+        parts.append(f"[0:a:0]atrim=start={start:.6f}:end={end:.6f},asetpts=PTS-STARTPTS[a{i}]")
+    labels = "".join(f"[a{i}]" for i in range(len(ranges)))
+    parts.append(f"{labels}concat=n={len(ranges)}:v=0:a=1[aout]")
+    return ";".join(parts)
+
+
+def prepare_audio_command(plan: dict, input_path: str, audio_path: str, duration: float,
+                          ranges: list = None) -> list:
+    """
+    Build the ffmpeg command that prepares the audio of a plan on its own, so
+    the final mux only has to stream-copy it. audio_path should be a Matroska
+    file, which holds any codec. With ranges, only those [start, end] seconds
+    are kept, sample-exact, which needs a transcode; duration should then be
+    their total length. Returns [] when the silence length is unknown.
+    """
+    if plan["audio"] == SILENCE:
+        if not duration:
+            return []
+        return [
+            "ffmpeg", "-f", "lavfi", "-i", SILENCE_SOURCE, "-t", f"{duration:.3f}",
+            *AUDIO_ARGS, "-y", audio_path
+        ]
+    if ranges:
+        return [
+            "ffmpeg", "-i", input_path, "-filter_complex", trim_audio_filter(ranges),
+            "-map", "[aout]", *AUDIO_ARGS, "-y", audio_path
+        ]
+    cmd = ["ffmpeg", "-i", input_path, "-map", "0:a:0", "-vn"]
+    cmd.extend(["-c:a", "copy"] if plan["audio"] == COPY else AUDIO_ARGS)
+    cmd.extend(["-y", audio_path])
+    return cmd
@@ -0,0 +1,133 @@
+import os
+
+MP4 = "mp4"
+HLS = "hls"
+DASH = "dash"
+PACKAGINGS = (MP4, HLS, DASH)
+
+MASTER_PLAYLIST = "master.m3u8"
+DASH_MANIFEST = "manifest.mpd"
+SEGMENT_SECONDS = int(os.getenv('RENDITION_SEGMENT_SECONDS', 4))
+# Bitrate cap of packaged renditions in bits per pixel per second (~6 Mbit/s at 1080p),
+# so players can pick a rendition from the advertised bandwidth
+BITS_PER_PIXEL = float(os.getenv('RENDITION_BITS_PER_PIXEL', 3.0))
+
+VIDEO_ARGS = ["libx264", "-preset", "medium", "-crf", "18"]
+PACKAGED_AUDIO_ARGS = ["-c:a", "aac", "-b:a", "128k"]
+
+
+def parse_renditions(spec: str) -> list:
+    """
+    Parse target resolutions like "1280:720,1920:1080" into
+    [(width, height)], largest first. Raises ValueError on bad input.
+    """
+    renditions = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        width, height = (int(v) for v in part.split(":"))
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Invalid resolution {part!r}")
+        renditions.add((width, height))
+    if not renditions:
+        raise ValueError("No resolutions given")
+    return sorted(renditions, key=lambda r: r[0] * r[1], reverse=True)
+
+
+def rendition_name(width: int, height: int) -> str:
+    return f"{width}x{height}"
+
+
+def split_filter(renditions: list, pre_filter: str = None) -> str:
+    """
+    filter_complex decoding the upscaled frames once and splitting them into
+    one scaled branch [v<i>] per rendition, keeping the aspect ratio, in
+    the 4:2:0 chroma every player decodes
+    """
+    head = "[0:v:0]" + (f"{pre_filter}," if pre_filter else "")
+    labels = "".join(f"[s{i}]" for i in range(len(renditions)))
+    parts = [f"{head}split={len(renditions)}{labels}"]
+    for i, (width, height) in enumerate(renditions):
+        parts.append(
+            f"[s{i}]scale={width}:{height}:force_original_aspect_ratio=decrease"
+            f":force_divisible_by=2:flags=lanczos,format=yuv420p[v{i}]"
+        )
+    return ";".join(parts)
+
+
+def _video_args(index: int, width: int, height: int, packaged: bool) -> list:
+    args = [f"-c:v:{index}", *VIDEO_ARGS]
+    if packaged:
+        # A capped bitrate gives each rendition of the ladder a known bandwidth
+        maxrate = int(width * height * BITS_PER_PIXEL)
+        args.extend([
+            f"-maxrate:v:{index}", str(maxrate), f"-bufsize:v:{index}", str(maxrate * 2),
+        ])
+    return args
+
+
+def rendition_outputs(renditions: list, packaging: str) -> dict:
+    """Files a rendition command writes, relative to its output dir"""
+    names = [rendition_name(w, h) for w, h in renditions]
+    if packaging == HLS:
+        return {"manifest": MASTER_PLAYLIST, "renditions": {name: f"{name}/index.m3u8" for name in names}}
+    if packaging == DASH:
+        return {"manifest": DASH_MANIFEST, "renditions": {name: DASH_MANIFEST for name in names}}
+    return {"manifest": None, "renditions": {name: f"{name}.mp4" for name in names}}
+
+
+def rendition_output_args(renditions: list, packaging: str, output_dir: str, audio_map: str,
+                          audio_args: list, pre_filter: str = None, vfr: bool = True,
+                          thread_args: list = ()) -> list:
+    """
+    ffmpeg output args encoding every rendition in one pass over the video
+    input 0. audio_map names the audio stream (e.g. "1:a:0") and audio_args
+    its codec args, which packaged outputs replace by AAC. MP4 packaging
+    writes one file per rendition, HLS a variant playlist per rendition
+    under a master playlist and DASH a single manifest with all of them.
+    thread_args (like ["-threads", "4"]) are applied to every output file.
+    """
+    args = ["-filter_complex", split_filter(renditions, pre_filter)]
+    fps_args = ["-fps_mode", "vfr"] if vfr else []
+    names = [rendition_name(w, h) for w, h in renditions]
+
+    if packaging == MP4:
+        for i, (width, height) in enumerate(renditions):
+            args.extend(["-map", f"[v{i}]", "-map", audio_map, *fps_args])
+            args.extend(_video_args(0, width, height, False))
+            args.extend(audio_args)
+            args.extend(thread_args)
+            args.extend(["-movflags", "+faststart", "-y", os.path.join(output_dir, f"{names[i]}.mp4")])
+        return args
+
+    # Packaged ladders re-encode the audio: copied codecs may not fit the segments
+    trailing = [a for a in audio_args if a == "-shortest"]
+    for i, (width, height) in enumerate(renditions):
+        args.extend(["-map", f"[v{i}]"])
+        args.extend(_video_args(i, width, height, True))
+    # Keyframes on segment boundaries in every rendition, so players can switch at any segment
+    args.extend([
+        *fps_args, "-force_key_frames", f"expr:gte(t,n_forced*{SEGMENT_SECONDS})", "-sc_threshold", "0",
+        *thread_args,
+    ])
+    if packaging == HLS:
+        # Each variant carries its own copy of the audio
+        for _ in renditions:
+            args.extend(["-map", audio_map])
+        args.extend([*PACKAGED_AUDIO_ARGS, *trailing])
+        stream_map = " ".join(f"v:{i},a:{i},name:{names[i]}" for i in range(len(renditions)))
+        args.extend([
+            "-f", "hls", "-hls_time", str(SEGMENT_SECONDS), "-hls_playlist_type", "vod",
+            "-hls_segment_filename", os.path.join(output_dir, "%v", "segment_%05d.ts"),
+            "-master_pl_name", MASTER_PLAYLIST, "-var_stream_map", stream_map,
+            "-y", os.path.join(output_dir, "%v", "index.m3u8"),
+        ])
+    else:
+        args.extend(["-map", audio_map, *PACKAGED_AUDIO_ARGS, *trailing])
+        args.extend([
+            "-f", "dash", "-seg_duration", str(SEGMENT_SECONDS), "-use_template", "1", "-use_timeline", "1",
+            "-adaptation_sets", "id=0,streams=v id=1,streams=a",
+            "-y", os.path.join(output_dir, DASH_MANIFEST),
+        ])
+    return args
@@ -0,0 +1,193 @@
+import os
+import math
+import shutil
+import logging
+import tempfile
+from functools import lru_cache
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# What one upscale job keeps busy: ffmpeg decoding and encoding around
+# Real-ESRGAN, the frames it holds in memory and the work dir on disk
+CPUS_PER_JOB = 4
+MEMORY_PER_JOB = 2 * 1024 ** 3
+TEMP_PER_JOB = 4 * 1024 ** 3
+# Real-ESRGAN splits frames into tiles of this size when memory per job is
+# below the threshold (0 lets it pick from the GPU memory)
+TILE_SIZES = ((1 * 1024 ** 3, 128), (2 * 1024 ** 3, 256))
+MAX_IO_THREADS = 4  # Real-ESRGAN threads loading and saving frames
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_dirs(controller: str):
+    """
+    Yield the cgroup dirs limiting this process for a controller, from its
+    own cgroup up to the root, for cgroup v2 and v1 hierarchies
+    """
+    for line in (_read("/proc/self/cgroup") or "").splitlines():
+        _, controllers, path = line.split(":", 2)
+        if controllers == "":
+            base = CGROUP_ROOT
+        elif controller in controllers.split(","):
+            base = os.path.join(CGROUP_ROOT, controllers)
+        else:
+            continue
+        parts = path.strip("/").split("/") if path.strip("/") else []
+        # Inside a container the cgroup is usually mounted at its own root
+        for depth in range(len(parts), -1, -1):
+            candidate = os.path.join(base, *parts[:depth])
+            if os.path.isdir(candidate):
+                yield candidate
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """CPUs the cgroup quota allows, None when unlimited"""
+    limits = []
+    for path in _cgroup_dirs("cpu"):
+        quota_period = _read(os.path.join(path, "cpu.max"))  # v2: "<quota> <period>" or "max <period>"
+        if quota_period is not None:
+            quota, _, period = quota_period.partition(" ")
+        else:
+            quota = _read(os.path.join(path, "cpu.cfs_quota_us"))  # v1: -1 when unlimited
+            period = _read(os.path.join(path, "cpu.cfs_period_us"))
+        try:
+            if quota not in (None, "max", "-1") and float(period) > 0:
+                limits.append(float(quota) / float(period))
+        except (TypeError, ValueError):
+            continue
+    return min(limits) if limits else None
+
+
+def cgroup_memory_limit() -> Optional[int]:
+    """Bytes of memory the cgroup allows, None when unlimited"""
+    limits = []
+    for path in _cgroup_dirs("memory"):
+        value = _read(os.path.join(path, "memory.max")) or _read(os.path.join(path, "memory.limit_in_bytes"))
+        if value and value.isdigit():
+            limits.append(int(value))
+    # v1 reports "unlimited" as a huge number, larger than any real memory
+    limits = [limit for limit in limits if limit < physical_memory()]
+    return min(limits) if limits else None
+
+
+def cgroup_memory_usage() -> Optional[int]:
+    """Bytes charged to this process's cgroup, tmpfs pages included; None outside a cgroup"""
+    for path in _cgroup_dirs("memory"):
+        value = _read(os.path.join(path, "memory.current")) or _read(os.path.join(path, "memory.usage_in_bytes"))
+        if value and value.isdigit():
+            return int(value)
+    return None
+
+
+def physical_memory() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def affinity_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not on Linux
+        return os.cpu_count() or 1
+
+
+def probe_host(temp_dir: str = None) -> dict:
+    """CPUs, memory and temp space this process can actually use"""
+    temp_dir = temp_dir or tempfile.gettempdir()
+    quota = cgroup_cpu_limit()
+    memory_limit = cgroup_memory_limit()
+    physical = physical_memory()
+    try:
+        temp_free = shutil.disk_usage(temp_dir).free
+    except OSError:
+        temp_free = None
+    cpus = affinity_cpus()
+    return {
+        "affinity_cpus": cpus,
+        "cpu_quota": quota,
+        "cpus": min(cpus, quota) if quota else cpus,
+        "physical_memory": physical,
+        "memory_limit": memory_limit,
+        "memory": min(memory_limit, physical) if memory_limit and physical else memory_limit or physical,
+        "temp_dir": temp_dir,
+        "temp_free": temp_free,
+    }
+
+
+def _override(name: str) -> Optional[int]:
+    """A value set in the environment (see the resource tuning section of config.py); 0 or unset derives it"""
+    value = os.getenv(name)
+    return int(value) if value and int(value) > 0 else None
+
+
+def derive_tuning(host: dict, processes: int = 1) -> dict:
+    """
+    Concurrency and threading that fit the host without oversubscribing it.
+    Job slots are limited by CPUs, memory and temp space; each of the
+    server's `processes` runs its share of them, and every job's ffmpeg
+    runs get the CPUs of one slot.
+    """
+    cpus = host["cpus"]
+    slots = max(1, int(cpus // CPUS_PER_JOB))
+    if host["memory"]:
+        slots = min(slots, max(1, host["memory"] // MEMORY_PER_JOB))
+    if host["temp_free"] is not None:
+        slots = min(slots, max(1, host["temp_free"] // TEMP_PER_JOB))
+    job_workers = _override("JOB_WORKERS") or max(1, slots // max(processes, 1))
+    jobs = job_workers * max(processes, 1)
+    threads = max(1, math.floor(cpus / jobs))
+    memory_per_job = host["memory"] / jobs if host["memory"] else None
+    tile_size = 0
+    for below, size in TILE_SIZES:
+        if memory_per_job is not None and memory_per_job < below:
+            tile_size = size
+            break
+    return {
+        "job_slots": slots,
+        "job_workers": job_workers,
+        "ffmpeg_threads": _override("FFMPEG_THREADS") or threads,
+        "ffmpeg_filter_threads": _override("FFMPEG_FILTER_THREADS") or threads,
+        "upscale_tile_size": _override("UPSCALE_TILE_SIZE") or tile_size,
+        "upscale_io_threads": _override("UPSCALE_IO_THREADS") or max(1, min(threads // 2, MAX_IO_THREADS)),
+    }
+
+
+@lru_cache(maxsize=None)
+def tuning() -> dict:
+    """Tuning of this server process, probed once. WORKERS is the number of server processes"""
+    host = probe_host()
+    derived = derive_tuning(host, int(os.getenv("WORKERS") or 1))
+    logger.info(f"Host resources: {host}, tuning: {derived}")
+    return derived
+
+
+def ffmpeg_thread_args() -> list:
+    """Output options limiting the encoder and filter threads of an ffmpeg run"""
+    settings = tuning()
+    return ["-threads", str(settings["ffmpeg_threads"]), "-filter_threads", str(settings["ffmpeg_filter_threads"])]
+
+
+def ffmpeg_decode_args() -> list:
+    """Input options limiting the decoder threads of the next ffmpeg input"""
+    return ["-threads", str(tuning()["ffmpeg_threads"])]
+
+
+def upscaler_args() -> list:
+    """Real-ESRGAN options for its tile size and frame load/save threads"""
+    settings = tuning()
+    io_threads = settings["upscale_io_threads"]
+    args = ["-j", f"{io_threads}:2:{io_threads}"]
+    if settings["upscale_tile_size"]:
+        args.extend(["-t", str(settings["upscale_tile_size"])])
+    return args
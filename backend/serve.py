@@ -0,0 +1,105 @@
+"""
+Production entry point: `python serve.py` from the backend directory.
+
+Runs WORKERS server processes (by default sized from the CPUs this process
+may use) with uvloop and httptools when installed. With gunicorn available
+the app is imported once in the master and forked into the workers
+(preload); otherwise uvicorn's own supervisor starts each worker from
+scratch. SIGTERM drains the server: new jobs get 503, running jobs have
+DRAIN_TIMEOUT seconds to finish and are then interrupted with their
+checkpoints kept (see app.begin_drain).
+
+Job and batch status, cancellation and traces go through a job database
+(see jobs.py) that every worker of the launch shares, so any worker answers
+the /jobs and /batch endpoints. It lives in the temp dir for the lifetime
+of the launch.
+"""
+import os
+import logging
+import tempfile
+import importlib.util
+
+from resources import probe_host, derive_tuning
+
+logger = logging.getLogger(__name__)
+
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', 10000))
+MAX_WORKERS = 8
+DRAIN_TIMEOUT = int(os.getenv('DRAIN_TIMEOUT', 25))  # Read by the app, which drains on SIGTERM
+# Seconds a worker may take to exit after SIGTERM, on top of the drain
+SHUTDOWN_GRACE = 10
+
+
+def default_workers() -> int:
+    """One process per job the host fits (see resources.py), each running one job at a time"""
+    return min(derive_tuning(probe_host())["job_slots"], MAX_WORKERS)
+
+
+def worker_count() -> int:
+    # WEB_CONCURRENCY is what most hosting platforms set
+    workers = os.getenv('WORKERS') or os.getenv('WEB_CONCURRENCY')
+    return max(1, int(workers)) if workers else default_workers()
+
+
+def installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def run_gunicorn(workers: int):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{HOST}:{PORT}")
+            self.cfg.set("workers", workers)
+            # uvicorn's worker picks uvloop and httptools when they are installed
+            self.cfg.set("worker_class", "uvicorn_worker.UvicornWorker" if installed("uvicorn_worker")
+                         else "uvicorn.workers.UvicornWorker")
+            self.cfg.set("preload_app", True)
+            self.cfg.set("graceful_timeout", DRAIN_TIMEOUT + SHUTDOWN_GRACE)
+
+        def load(self):
+            from app import app
+            return app
+
+    Application().run()
+
+
+def run_uvicorn(workers: int):
+    import uvicorn
+    uvicorn.run(
+        "app:app", host=HOST, port=PORT, workers=workers,
+        loop="uvloop" if installed("uvloop") else "auto",
+        http="httptools" if installed("httptools") else "auto",
+        timeout_graceful_shutdown=DRAIN_TIMEOUT + SHUTDOWN_GRACE,
+    )
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    workers = worker_count()
+    # Workers split the host's job slots between them
+    os.environ["WORKERS"] = str(workers)
+    use_gunicorn = os.name == "posix" and installed("gunicorn")
+    logger.info(
+        f"Serving on {HOST}:{PORT} with {workers} workers via {'gunicorn' if use_gunicorn else 'uvicorn'}, "
+        f"uvloop: {installed('uvloop')}, httptools: {installed('httptools')}"
+    )
+    # Read by jobs.py in every worker; a database of this launch is removed when it ends
+    own_job_db = "JOB_DB" not in os.environ
+    if own_job_db:
+        os.environ["JOB_DB"] = os.path.join(tempfile.gettempdir(), f"upscale_jobs_{os.getpid()}.sqlite3")
+    try:
+        if use_gunicorn:
+            run_gunicorn(workers)
+        else:
+            run_uvicorn(workers)
+    finally:
+        if own_job_db:
+            from jobs import remove_job_db
+            remove_job_db(os.environ["JOB_DB"])
+
+
+if __name__ == "__main__":
+    main()
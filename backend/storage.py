@@ -0,0 +1,361 @@
+import os
+import re
+import time
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional
+try:
+    import fcntl
+except ImportError:  # Windows: a single server process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Names written by the API: "<uuid>_<original name>" for uploads and
+# "<uuid>_upscaled.mp4" / "<uuid>_audiofixed.mp4" / preview files for results,
+# and "<uuid>_renditions" directories for multi-rendition results
+UUID_PREFIX = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_")
+OUTPUT_SUFFIXES = ("_upscaled.mp4", "_audiofixed.mp4", "_preview.mp4", "_before.png", "_after.png")
+OUTPUT_DIR_SUFFIX = "_renditions"
+WORK_DIR_PREFIX = "realesrgan_"
+# Empty files server processes lock to run a job key one at a time
+LOCK_FILE_PREFIX = f".{WORK_DIR_PREFIX}"
+LOCK_FILE_SUFFIX = ".lock"
+
+# Rough on-disk size of a PNG frame relative to its raw RGB24 size; the
+# uncompressed frame formats are about the raw size
+PNG_RATIO = 0.5
+
+
+def _parse_size(size_str: str) -> int:
+    """Parse size string (e.g., '100MB', '1GB') to bytes"""
+    size_str = size_str.upper().strip()
+    for suffix, factor in (("GB", 1024 ** 3), ("MB", 1024 ** 2), ("KB", 1024), ("B", 1)):
+        if size_str.endswith(suffix):
+            return int(float(size_str[:-len(suffix)]) * factor)
+    return int(size_str)
+
+
+def tree_size(path: str, seen: set = None) -> int:
+    """
+    Bytes of the files under a path. Hard links (the frame cache links
+    upscaled frames) are counted once per inode, across every call sharing
+    `seen`.
+    """
+    seen = set() if seen is None else seen
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
+
+class InsufficientStorage(Exception):
+    """Raised when a job cannot get the disk space it needs, even after eviction"""
+
+
+class StorageManager:
+    """
+    Tracks the bytes used by uploads, job work dirs and finished outputs and
+    keeps them within a disk budget:
+    - finished outputs expire after OUTPUT_TTL and are evicted least recently
+      used first when space is needed
+    - work dirs not touched for WORK_DIR_TTL are orphans of crashed or
+      abandoned jobs and are swept, as are job lock files as old
+    - jobs reserve their estimated size before starting, so they are refused
+      up front instead of failing halfway with ENOSPC
+    Inputs of queued and running jobs are held (hold_input) and never swept,
+    and outputs of running jobs are never evicted.
+    """
+
+    def __init__(self, output_dir: str, work_roots: list):
+        self.output_dir = output_dir
+        self.work_roots = work_roots
+        self.budget = _parse_size(os.getenv('STORAGE_BUDGET', '10GB'))
+        self.min_free = _parse_size(os.getenv('STORAGE_MIN_FREE', '512MB'))
+        self.output_ttl = int(os.getenv('OUTPUT_TTL', 24 * 3600))
+        self.work_dir_ttl = int(os.getenv('WORK_DIR_TTL', 6 * 3600))
+        self.sweep_interval = int(os.getenv('STORAGE_SWEEP_INTERVAL', 600))
+        # Running jobs: token -> (estimate, job key, output path)
+        self._reservations = {}
+        # Inputs of queued and running jobs: path -> open file holding a shared lock on it
+        self._inputs = {}
+        self._lock = threading.Lock()
+
+    def _uuid_files(self):
+        """
+        Yield (path, stat) for the uploads and outputs in the output dir.
+        Output directories are reported as one entry; use _entry_size for
+        their size.
+        """
+        try:
+            entries = list(os.scandir(self.output_dir))
+        except OSError:
+            return
+        for entry in entries:
+            if not UUID_PREFIX.match(entry.name):
+                continue
+            if entry.is_file(follow_symlinks=False) or (
+                    entry.name.endswith(OUTPUT_DIR_SUFFIX) and entry.is_dir(follow_symlinks=False)):
+                try:
+                    yield entry.path, entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+    @staticmethod
+    def _is_output(path: str) -> bool:
+        return path.endswith(OUTPUT_SUFFIXES) or path.endswith(OUTPUT_DIR_SUFFIX)
+
+    def _entry_size(self, path: str, st: os.stat_result, seen: set = None) -> int:
+        return tree_size(path, seen) if path.endswith(OUTPUT_DIR_SUFFIX) else st.st_size
+
+    def _work_dirs(self):
+        """Yield the paths of job work dirs in every work root"""
+        for root in self.work_roots:
+            try:
+                entries = list(os.scandir(root))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith(WORK_DIR_PREFIX) and entry.is_dir(follow_symlinks=False):
+                    yield entry.path
+
+    def _lock_files(self):
+        """Yield (path, stat) for the job lock files in every work root"""
+        for root in self.work_roots:
+            try:
+                entries = list(os.scandir(root))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith(LOCK_FILE_PREFIX) and entry.name.endswith(LOCK_FILE_SUFFIX):
+                    try:
+                        yield entry.path, entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+
+    @staticmethod
+    def _last_activity(path: str) -> float:
+        """Latest mtime of a work dir, its frame dirs and its checkpoint"""
+        latest = 0.0
+        for sub in ("", "frames", "upscaled", "checkpoint.json"):
+            try:
+                latest = max(latest, os.stat(os.path.join(path, sub)).st_mtime)
+            except OSError:
+                pass
+        return latest
+
+    def usage(self) -> dict:
+        """Bytes currently used per category"""
+        seen = set()
+        outputs = uploads = 0
+        for path, st in self._uuid_files():
+            if self._is_output(path):
+                outputs += self._entry_size(path, st, seen)
+            else:
+                uploads += st.st_size
+        work = sum(tree_size(path, seen) for path in self._work_dirs())
+        return {
+            "uploads": uploads,
+            "work": work,
+            "outputs": outputs,
+            "total": uploads + work + outputs,
+            "reserved": self._reserved(),
+            "budget": self.budget,
+        }
+
+    def _held(self, job_key: Optional[str], output_path: Optional[str]) -> int:
+        """Bytes a running job already wrote to its work dir and output"""
+        seen = set()
+        held = 0
+        if job_key:
+            for root in self.work_roots:
+                held += tree_size(os.path.join(root, f"{WORK_DIR_PREFIX}{job_key}"), seen)
+        if output_path:
+            if os.path.isdir(output_path):
+                held += tree_size(output_path, seen)
+            elif os.path.exists(output_path):
+                try:
+                    held += os.path.getsize(output_path)
+                except OSError:
+                    pass
+        return held
+
+    def _reserved(self) -> int:
+        """
+        Bytes running jobs may still write: their estimates less what they
+        already hold, which usage() and the free disk space count already
+        """
+        return sum(max(estimate - self._held(job_key, output_path), 0)
+                   for estimate, job_key, output_path in list(self._reservations.values()))
+
+    def hold_input(self, path: str):
+        """
+        Keep the input of a queued or running job from being swept as an
+        orphaned upload, however long it waits, until release_input(). Other
+        server processes see the hold as a shared lock on the file.
+        """
+        handle = None
+        if fcntl is not None:
+            try:
+                handle = open(path, "rb")
+                fcntl.flock(handle, fcntl.LOCK_SH)
+            except OSError as e:
+                logger.warning(f"Failed to lock input {path}: {e}")
+                if handle is not None:
+                    handle.close()
+                handle = None
+        self._inputs[path] = handle
+
+    def release_input(self, path: str):
+        handle = self._inputs.pop(path, None)
+        if handle is not None:
+            handle.close()
+
+    def _input_held(self, path: str) -> bool:
+        """Whether a job of this or another server process holds an input"""
+        if path in self._inputs:
+            return True
+        if fcntl is None:
+            return False
+        try:
+            with open(path, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def touch(self, filename: str):
+        """Mark an output as accessed, for LRU eviction"""
+        path = os.path.join(self.output_dir, os.path.basename(filename))
+        try:
+            st = os.stat(path)
+            os.utime(path, (time.time(), st.st_mtime))
+        except OSError:
+            pass
+
+    def _remove(self, path: str, reason: str) -> int:
+        try:
+            if os.path.isdir(path):
+                size = tree_size(path)
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                size = os.path.getsize(path)
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"Failed to remove {path}: {e}")
+            return 0
+        logger.info(f"Removed {reason} {path} ({size} bytes)")
+        return size
+
+    def sweep(self) -> int:
+        """Remove expired outputs and orphaned work dirs and uploads; returns bytes freed"""
+        now = time.time()
+        freed = 0
+        for path, st in self._uuid_files():
+            if self._is_output(path):
+                if now - st.st_mtime > self.output_ttl:
+                    freed += self._remove(path, "expired output")
+            elif now - st.st_mtime > self.work_dir_ttl and not self._input_held(path):
+                freed += self._remove(path, "orphaned upload")
+        for path in self._work_dirs():
+            if now - self._last_activity(path) > self.work_dir_ttl:
+                freed += self._remove(path, "orphaned work dir")
+        for path, st in self._lock_files():
+            if now - st.st_mtime > self.work_dir_ttl:
+                self._remove(path, "stale job lock")
+        return freed
+
+    def evict(self, needed: int) -> int:
+        """
+        Evict finished outputs, least recently used first, until `needed`
+        bytes are freed. Outputs of running jobs are still being written and
+        are kept.
+        """
+        writing = {output_path for _, _, output_path in list(self._reservations.values()) if output_path}
+        outputs = sorted(
+            (st.st_atime, path) for path, st in self._uuid_files()
+            if self._is_output(path) and path not in writing
+        )
+        freed = 0
+        for _, path in outputs:
+            if freed >= needed:
+                break
+            freed += self._remove(path, "least recently used output")
+        return freed
+
+    def _shortfall(self, estimate: int) -> int:
+        """Bytes that must be freed before `estimate` more bytes fit"""
+        used = self.usage()["total"]
+        reserved = self._reserved()
+        over_budget = used + reserved + estimate - self.budget
+        try:
+            free = shutil.disk_usage(self.work_roots[0]).free
+        except OSError:
+            free = 0
+        over_disk = reserved + estimate + self.min_free - free
+        return max(over_budget, over_disk, 0)
+
+    @contextmanager
+    def reserve(self, estimate: int, job_key: Optional[str] = None, output_path: Optional[str] = None):
+        """
+        Reserve `estimate` bytes for the duration of a job. With the job's key
+        and output path, what the job has already written (a resumed work dir,
+        or its progress so far) is charged once, as used space, instead of
+        also being part of the reservation.
+        """
+        with self._lock:
+            needed = max(estimate - self._held(job_key, output_path), 0)
+            shortfall = self._shortfall(needed)
+            if shortfall:
+                self.sweep()
+                shortfall = self._shortfall(needed)
+            if shortfall:
+                self.evict(shortfall)
+                shortfall = self._shortfall(needed)
+            if shortfall:
+                raise InsufficientStorage(
+                    f"Job needs about {needed} bytes, {shortfall} more than are available"
+                )
+            token = object()
+            self._reservations[token] = (estimate, job_key, output_path)
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._reservations[token]
+
+    def estimate_job_bytes(self, analysis: dict, scale: int, input_size: int,
+                           selected_duration: Optional[float] = None, outputs: int = 1,
+                           compressed_frames: bool = True) -> int:
+        """
+        Estimate the peak disk usage of an upscale job from the probe analysis.
+        selected_duration is the length of the trimmed ranges, if any, outputs
+        the number of renditions written and compressed_frames whether frames
+        are extracted as PNG or in an uncompressed format. Real-ESRGAN always
+        writes PNG.
+        """
+        width = analysis.get("width") or 0
+        height = analysis.get("height") or 0
+        duration = analysis.get("duration") or 0
+        if not (width and height and duration):
+            # Without a usable probe assume a generous multiple of the input
+            return input_size * 50
+        share = min(selected_duration / duration, 1.0) if selected_duration else 1.0
+        frames = int(duration * share * (analysis.get("fps") or 30)) + 1  # Every source frame is extracted
+        extracted_ratio = PNG_RATIO if compressed_frames else 1.0
+        work = frames * width * height * 3 * (extracted_ratio + scale * scale * PNG_RATIO)
+        output = input_size * share * scale * scale * outputs
+        return int(work + output)
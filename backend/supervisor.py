@@ -0,0 +1,191 @@
+import os
+import time
+import signal
+import logging
+import threading
+import subprocess
+import contextvars
+
+from tracing import record_process
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(BaseException):
+    """
+    Raised in a job's thread once the job is cancelled. Like
+    asyncio.CancelledError it is not an Exception, so the pipeline's
+    catch-all error handlers let it through.
+    """
+
+
+class JobInterrupted(JobCancelled):
+    """
+    Raised in a job's thread when the server stops it to shut down. Unlike a
+    cancelled job, an interrupted one keeps its checkpoint for a retry.
+    """
+
+
+class JobControl:
+    """
+    Cancellation handle of one job. Every subprocess the job starts through
+    run_process() is tracked, and cancel() kills their process groups at once.
+    interrupt() stops the job the same way but raises JobInterrupted.
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.interrupted = False
+        self._processes = set()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        self.cancelled.set()
+        with self._lock:
+            processes = list(self._processes)
+            callbacks, self._callbacks = self._callbacks, []
+        for process in processes:
+            _kill_group(process)
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        """Call callback once the job is cancelled, e.g. to drop it from a queue"""
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def interrupt(self):
+        self.interrupted = True
+        self.cancel()
+
+    def check(self):
+        """Raise JobCancelled (or JobInterrupted) if the job was stopped"""
+        if self.cancelled.is_set():
+            raise JobInterrupted() if self.interrupted else JobCancelled()
+
+    def _track(self, process):
+        with self._lock:
+            self._processes.add(process)
+        # A cancel between the check before starting and tracking must not be missed
+        if self.cancelled.is_set():
+            _kill_group(process)
+
+    def _untrack(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+
+# Control of the job running in the current thread (or copied context)
+current_job = contextvars.ContextVar("current_job", default=None)
+
+# Controls of the jobs running in any thread, for interrupt_running()
+_running = set()
+_running_lock = threading.Lock()
+
+
+def _kill_group(process):
+    """
+    Kill a process started by run_process() with everything it spawned.
+    Without process groups (Windows) only the process itself is killed.
+    """
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _read_into(stream, chunks):
+    chunks.append(stream.read())
+    stream.close()
+
+
+def run_process(cmd, timeout=None):
+    """
+    Run a command like subprocess.run(cmd, capture_output=True, text=True,
+    timeout=timeout), in its own process group so a timeout or a cancel of
+    the current job kills the whole tree. Raises JobCancelled when the job
+    is cancelled before or while the command runs. Output that is not
+    UTF-8 is decoded with replacement characters.
+
+    The child is reaped with os.wait4 so its CPU time and peak RSS are
+    recorded in the current trace along with its argv; where os.wait4 does
+    not exist (Windows) only its argv, exit code and duration are.
+    """
+    control = current_job.get()
+    if control is not None:
+        control.check()
+    started = time.perf_counter()
+    # Output is decoded leniently: ffmpeg echoes file metadata that need not be UTF-8
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8",
+                               errors="replace", start_new_session=True)
+    if control is not None:
+        control._track(process)
+    stdout, stderr = [], []
+    readers = [threading.Thread(target=_read_into, args=(process.stdout, stdout), daemon=True),
+               threading.Thread(target=_read_into, args=(process.stderr, stderr), daemon=True)]
+    timed_out = threading.Event()
+
+    def expire():
+        timed_out.set()
+        _kill_group(process)
+
+    timer = threading.Timer(timeout, expire) if timeout else None
+    rusage = None
+    try:
+        for reader in readers:
+            reader.start()
+        if timer:
+            timer.start()
+        if hasattr(os, "wait4"):
+            _, status, rusage = os.wait4(process.pid, 0)
+            # Tell Popen the child is reaped so it does not wait for it again
+            process.returncode = os.waitstatus_to_exitcode(status)
+        else:
+            process.wait()
+        for reader in readers:
+            reader.join()
+    finally:
+        if timer:
+            timer.cancel()
+        if control is not None:
+            control._untrack(process)
+        if process.returncode is None:
+            # Interrupted by anything else: do not leave the tree running
+            _kill_group(process)
+            process.wait()
+        record_process(cmd, started, time.perf_counter() - started, process.returncode, rusage)
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout, "".join(stdout), "".join(stderr))
+    if control is not None:
+        control.check()
+    return subprocess.CompletedProcess(cmd, process.returncode, "".join(stdout), "".join(stderr))
+
+
+def run_controlled(control, fn, *args, **kwargs):
+    """Call fn with control as the current job, in a worker thread"""
+    token = current_job.set(control)
+    with _running_lock:
+        _running.add(control)
+    try:
+        control.check()
+        return fn(*args, **kwargs)
+    finally:
+        with _running_lock:
+            _running.discard(control)
+        current_job.reset(token)
+
+
+def interrupt_running() -> int:
+    """Interrupt every job running under run_controlled(); returns how many there were"""
+    with _running_lock:
+        controls = list(_running)
+    for control in controls:
+        control.interrupt()
+    return len(controls)
@@ -0,0 +1,207 @@
+import os
+import math
+import uuid
+import logging
+from resources import tuning
+
+logger = logging.getLogger(__name__)
+
+# Anchor frames get the full model; frames in between are warped from the
+# last anchor with optical flow computed at source resolution
+ANCHOR_INTERVAL = int(os.getenv('TEMPORAL_ANCHOR_INTERVAL', 8))  # Force an anchor every N frames
+SCENE_CUT_THRESHOLD = float(os.getenv('TEMPORAL_SCENE_CUT', 40.0))  # Mean abs diff of thumbnails
+# Quality guard: a block whose warped source differs from the real frame by
+# more than BLOCK_ERROR (mean abs diff, 0-255) is re-done by the model; a
+# frame with more than MAX_BAD_FRACTION bad blocks becomes an anchor instead
+BLOCK_SIZE = 16
+BLOCK_PAD = 8  # Context around re-done blocks so the model sees their surroundings
+BLOCK_ERROR = float(os.getenv('TEMPORAL_BLOCK_ERROR', 8.0))
+MAX_BAD_FRACTION = float(os.getenv('TEMPORAL_MAX_BAD_FRACTION', 0.25))
+
+
+class TemporalUpscaler:
+    """
+    Upscales a sequence of frames running the model only on anchor frames
+    (the first frame, scene cuts and every ANCHOR_INTERVAL-th frame). The
+    frames in between are built by warping the upscaled anchor along the
+    optical flow between the source frames. Blocks where the flow does not
+    reproduce the source frame are upscaled by the model in one mosaic.
+
+    Frames must be fed in order, a batch at a time. The flow is checked at
+    source resolution, so a whole batch is planned before the model runs:
+    its anchors and mosaics then go through a single model run.
+    upscale_batch_fn(in_frames, out_frames, patches) runs it and returns
+    None on failure, like video_processing.upscale_frame_batch; patches maps
+    the mosaics among in_frames to their share of a full frame's pixels.
+    """
+
+    def __init__(self, scale, work_dir, upscale_batch_fn):
+        # Heavy imports only when temporal mode is used
+        import cv2
+        import numpy as np
+        # Flow estimation gets the CPUs of the job, not every core of the host
+        cv2.setNumThreads(tuning()["ffmpeg_threads"])
+        self.cv2 = cv2
+        self.np = np
+        self.scale = int(scale)
+        self.work_dir = work_dir
+        self.upscale_batch_fn = upscale_batch_fn
+        # Last anchor: source gray, upscaled frame path and, once the model ran, upscaled image
+        self.anchor = None
+        self.previous_thumb = None
+        self.since_anchor = 0
+        self.stats = {"anchors": 0, "warped": 0, "patched_blocks": 0}
+
+    def _thumbnail(self, gray):
+        return self.cv2.resize(gray, (64, 36), interpolation=self.cv2.INTER_AREA).astype(self.np.float32)
+
+    def _is_scene_cut(self, thumb):
+        if self.previous_thumb is None:
+            return True
+        return float(self.np.abs(thumb - self.previous_thumb).mean()) > SCENE_CUT_THRESHOLD
+
+    def process_batch(self, in_frames, out_frames):
+        """Upscale a batch of frames with one model run; returns False on failure"""
+        cv2 = self.cv2
+        model_in, model_out, patches = [], [], {}
+        anchors = []  # Anchors of this batch, upscaled by the model run
+        warps = []  # (out frame, anchor, flow, bad blocks, mosaic) of the other frames
+        try:
+            for in_frame, out_frame in zip(in_frames, out_frames):
+                source = cv2.imread(in_frame, cv2.IMREAD_COLOR)
+                if source is None:
+                    logger.error(f"Could not read {in_frame}")
+                    return False
+                gray = cv2.cvtColor(source, cv2.COLOR_BGR2GRAY)
+                thumb = self._thumbnail(gray)
+                scene_cut = self._is_scene_cut(thumb)
+                self.previous_thumb = thumb
+
+                if self.anchor is None or scene_cut or self.since_anchor >= ANCHOR_INTERVAL:
+                    anchors.append(self._new_anchor(gray, out_frame))
+                    model_in.append(in_frame)
+                    model_out.append(out_frame)
+                    continue
+                flow, bad_blocks, total_blocks = self._flow_from_anchor(gray)
+                if len(bad_blocks) > total_blocks * MAX_BAD_FRACTION:
+                    # Too much the flow cannot explain, treat the frame as a new anchor
+                    anchors.append(self._new_anchor(gray, out_frame))
+                    model_in.append(in_frame)
+                    model_out.append(out_frame)
+                    continue
+                mosaic = None
+                if bad_blocks:
+                    mosaic = self._write_mosaic(source, bad_blocks)
+                    model_in.append(mosaic["in"])
+                    model_out.append(mosaic["out"])
+                    patches[mosaic["in"]] = mosaic["share"]
+                warps.append((out_frame, self.anchor, flow, bad_blocks, mosaic))
+                self.since_anchor += 1
+
+            if model_in and self.upscale_batch_fn(model_in, model_out, patches) is None:
+                return False
+            for anchor in anchors:
+                anchor["upscaled"] = cv2.imread(anchor["out_frame"], cv2.IMREAD_COLOR)
+                if anchor["upscaled"] is None:
+                    logger.error(f"Could not read upscaled anchor {anchor['out_frame']}")
+                    return False
+            for out_frame, anchor, flow, bad_blocks, mosaic in warps:
+                warped = self._warp(anchor["upscaled"], flow)
+                if mosaic and not self._paste_mosaic(warped, mosaic, bad_blocks, flow.shape[:2]):
+                    return False
+                cv2.imwrite(out_frame, warped, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+                self.stats["warped"] += 1
+                self.stats["patched_blocks"] += len(bad_blocks)
+            return True
+        finally:
+            for mosaic_in, mosaic_out in zip(model_in, model_out):
+                if mosaic_in not in patches:
+                    continue
+                for path in (mosaic_in, mosaic_out):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def _new_anchor(self, gray, out_frame):
+        self.anchor = {"gray": gray, "out_frame": out_frame, "upscaled": None}
+        self.since_anchor = 0
+        self.stats["anchors"] += 1
+        return self.anchor
+
+    def _flow_from_anchor(self, gray):
+        """
+        Optical flow from this frame to the anchor, with the (row, col)
+        origins of blocks where it is unreliable and the total block count
+        """
+        cv2, np = self.cv2, self.np
+        anchor_gray = self.anchor["gray"]
+        height, width = gray.shape
+        # Flow from this frame to the anchor: frame(y, x) ~ anchor(y + fy, x + fx)
+        flow = cv2.calcOpticalFlowFarneback(gray, anchor_gray, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+
+        # Check the flow at source resolution: warp the anchor's source and compare
+        grid_x, grid_y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+        warped_gray = cv2.remap(anchor_gray, grid_x + flow[..., 0], grid_y + flow[..., 1],
+                                cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        error = cv2.absdiff(warped_gray, gray).astype(np.float32)
+        bad_blocks = []
+        rows = math.ceil(height / BLOCK_SIZE)
+        cols = math.ceil(width / BLOCK_SIZE)
+        for row in range(rows):
+            for col in range(cols):
+                y, x = row * BLOCK_SIZE, col * BLOCK_SIZE
+                if error[y:y + BLOCK_SIZE, x:x + BLOCK_SIZE].mean() > BLOCK_ERROR:
+                    bad_blocks.append((y, x))
+        return flow, bad_blocks, rows * cols
+
+    def _warp(self, anchor_upscaled, flow):
+        """Apply the flow, scaled up, to the upscaled anchor"""
+        cv2, np = self.cv2, self.np
+        s = self.scale
+        up_height, up_width = anchor_upscaled.shape[:2]
+        up_flow = cv2.resize(flow, (up_width, up_height), interpolation=cv2.INTER_LINEAR) * s
+        up_x, up_y = np.meshgrid(np.arange(up_width, dtype=np.float32), np.arange(up_height, dtype=np.float32))
+        return cv2.remap(anchor_upscaled, up_x + up_flow[..., 0], up_y + up_flow[..., 1],
+                         cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    def _write_mosaic(self, source, bad_blocks):
+        """Write the unreliable blocks, with context around them, side by side in one image for the model"""
+        cv2, np = self.cv2, self.np
+        tile = BLOCK_SIZE + 2 * BLOCK_PAD
+        height, width = source.shape[:2]
+        padded = cv2.copyMakeBorder(source, BLOCK_PAD, BLOCK_PAD + BLOCK_SIZE, BLOCK_PAD, BLOCK_PAD + BLOCK_SIZE,
+                                    cv2.BORDER_REFLECT)
+        cols = math.ceil(math.sqrt(len(bad_blocks)))
+        rows = math.ceil(len(bad_blocks) / cols)
+        mosaic = np.zeros((rows * tile, cols * tile, 3), dtype=source.dtype)
+        for i, (y, x) in enumerate(bad_blocks):
+            r, c = divmod(i, cols)
+            mosaic[r * tile:(r + 1) * tile, c * tile:(c + 1) * tile] = padded[y:y + tile, x:x + tile]
+
+        name = f"mosaic_{uuid.uuid4()}"
+        mosaic_in = os.path.join(self.work_dir, f"{name}.png")
+        cv2.imwrite(mosaic_in, mosaic, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        return {
+            "in": mosaic_in,
+            "out": os.path.join(self.work_dir, f"{name}_up.png"),
+            "cols": cols,
+            # The model's time on a mosaic goes with its pixels, not a whole frame
+            "share": mosaic.shape[0] * mosaic.shape[1] / (height * width),
+        }
+
+    def _paste_mosaic(self, warped, mosaic, bad_blocks, size):
+        """Paste the upscaled blocks of a mosaic over the warped frame"""
+        upscaled = self.cv2.imread(mosaic["out"], self.cv2.IMREAD_COLOR)
+        if upscaled is None:
+            logger.error(f"Could not read upscaled mosaic {mosaic['out']}")
+            return False
+        s = self.scale
+        tile = BLOCK_SIZE + 2 * BLOCK_PAD
+        height, width = size
+        for i, (y, x) in enumerate(bad_blocks):
+            r, c = divmod(i, mosaic["cols"])
+            block_h = min(BLOCK_SIZE, height - y) * s
+            block_w = min(BLOCK_SIZE, width - x) * s
+            top = (r * tile + BLOCK_PAD) * s
+            left = (c * tile + BLOCK_PAD) * s
+            warped[y * s:y * s + block_h, x * s:x * s + block_w] = upscaled[top:top + block_h, left:left + block_w]
+        return True
@@ -0,0 +1,135 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+import app as app_module
+from supervisor import current_job, run_process
+
+
+def multipart_upload(filename: str, content: bytes, boundary: str = "testboundary") -> bytes:
+    return (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        "Content-Type: video/mp4\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+
+
+async def upload_then_disconnect(body: bytes, boundary: str = "testboundary"):
+    """POST body to /upload through the whole ASGI stack, then leave once the request is read"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/upload", "raw_path": b"/upload", "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"testserver"),
+                    (b"content-type", f"multipart/form-data; boundary={boundary}".encode()),
+                    (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 12345), "server": ("testserver", 80),
+    }
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return {"type": "http.disconnect"}
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    await app_module.app(scope, receive, send)
+    return messages
+
+
+def test_client_disconnect_cancels_job(monkeypatch):
+    controls = []
+
+    def slow_job(*args, **kwargs):
+        controls.append(current_job.get())
+        run_process(["sleep", "30"])
+
+    monkeypatch.setattr(app_module, "run_upscale_job", slow_job)
+    monkeypatch.setattr(app_module, "DISCONNECT_POLL", 0.1)
+
+    started = time.monotonic()
+    messages = asyncio.run(asyncio.wait_for(
+        upload_then_disconnect(multipart_upload("clip.mp4", b"\0" * 1024)), timeout=10
+    ))
+
+    assert time.monotonic() - started < 5
+    assert controls and controls[0].cancelled.is_set()
+    assert messages[0]["type"] == "http.response.start"
+    assert messages[0]["status"] == 499
+
+
+def test_draining_refuses_new_jobs(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(app_module.draining, "is_set", lambda: True)
+    client = TestClient(app_module.app)
+    response = client.post("/upload", files={"file": ("clip.mp4", b"\0", "video/mp4")})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert client.get("/").status_code == 200
+
+
+@pytest.mark.parametrize("path, touched", [
+    ("/videos/abc_upscaled.mp4", "abc_upscaled.mp4"),
+    ("/videos/abc_renditions/720p.mp4", "abc_renditions"),
+])
+def test_downloads_mark_outputs_accessed(monkeypatch, path, touched):
+    from fastapi.testclient import TestClient
+
+    calls = []
+    monkeypatch.setattr(app_module.storage, "touch", calls.append)
+    TestClient(app_module.app).get(path)
+    assert calls == [touched]
+
+
+PROBE = {
+    "streams": [{"codec_type": "video", "codec_name": "h264", "width": 1280, "height": 720,
+                 "r_frame_rate": "25/1"}],
+    "format": {"duration": "60", "size": "1000000", "bit_rate": "0"},
+}
+
+
+def test_preview_reserves_storage(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    previews = []
+    monkeypatch.setattr(app_module, "probe_media", lambda path: PROBE)
+    monkeypatch.setattr(app_module, "planned_frame_format", lambda *args: "png")
+    monkeypatch.setattr(app_module, "preview_upscale", lambda *args, **kwargs: previews.append(args))
+    monkeypatch.setattr(app_module.storage, "budget", 1024 * 1024)
+
+    response = TestClient(app_module.app).post("/preview", files={"file": ("clip.mp4", b"\0" * 1024, "video/mp4")})
+    assert response.status_code == 507
+    assert previews == []
+
+
+def test_parse_time_ranges():
+    assert app_module.parse_time_ranges(None, None, None, 60) is None
+    assert app_module.parse_time_ranges(10, None, None, 60) == [[10, 60]]
+    assert app_module.parse_time_ranges(None, 5, None, 60) == [[0.0, 5]]
+    # Ranges override start/end, come back sorted and are clipped to the duration
+    assert app_module.parse_time_ranges(1, 2, "30.5-90, 10-20", 60) == [[10.0, 20.0], [30.5, 60]]
+    # An unknown duration clips nothing
+    assert app_module.parse_time_ranges(None, None, "10-20", 0) == [[10.0, 20.0]]
+
+
+@pytest.mark.parametrize("ranges", ["10", "a-b", "10-20-30", "20-10", "-5-10", "10-20,15-25", "70-80"])
+def test_parse_time_ranges_rejects_bad_ranges(ranges):
+    with pytest.raises(HTTPException) as error:
+        app_module.parse_time_ranges(None, None, ranges, 60)
+    assert error.value.status_code == 400
+
+
+def test_job_key_follows_content_and_options():
+    digest = "ab" * 32
+    key = app_module.get_job_key(digest, "2")
+    assert key == f"{digest[:32]}_x2"
+    assert app_module.get_job_key(digest, "2", frame_rate_mode="adaptive", temporal=True) == f"{key}_adaptive_temporal"
+    assert app_module.get_job_key(digest, "2", [[0, 10]]) != app_module.get_job_key(digest, "2", [[0, 11]])
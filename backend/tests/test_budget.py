@@ -0,0 +1,89 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import budget
+from budget import JobBudget, DeadlineExceeded, DEFAULT_COSTS, BUDGET_SAFETY, MIN_STAGE_SECONDS
+
+
+@pytest.fixture(autouse=True)
+def cost_model(tmp_path, monkeypatch):
+    path = tmp_path / "costs.json"
+    monkeypatch.setattr(budget, "COST_MODEL_FILE", str(path))
+    return path
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(budget, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def megapixel_budget():
+    # One megapixel frames at scale 1: expected seconds are the cost per megapixel times the frames
+    return JobBudget(1000, 1000, 1)
+
+
+def test_stage_allowance(clock):
+    job = megapixel_budget()
+    job.start("upscale", 100)
+    expected = DEFAULT_COSTS["upscale"] * 100
+    assert job.deadline == pytest.approx(expected * BUDGET_SAFETY + MIN_STAGE_SECONDS)
+
+
+def test_advance_raises_when_the_rate_will_miss_the_deadline(clock):
+    job = megapixel_budget()
+    job.start("upscale", 100)
+    clock.now = 10
+    job.advance("upscale", 10)
+    # Too little done to trust the rate yet
+    clock.now = 100
+    job.advance("upscale", 5)
+    with pytest.raises(DeadlineExceeded):
+        job.advance("upscale", 10)
+
+
+def test_advance_raises_past_the_deadline(clock):
+    job = megapixel_budget()
+    job.start("upscale", 100)
+    clock.now = job.deadline + 1
+    with pytest.raises(DeadlineExceeded):
+        job.advance("upscale", 99)
+
+
+def test_unused_time_carries_over(clock):
+    job = megapixel_budget()
+    job.start("extract", 100)
+    extract_deadline = job.deadline
+    clock.now = 1
+    job.finish("extract")
+    job.start("upscale", 100)
+    # The new stage gets its allowance on top of the time extract left unused
+    assert job.deadline == pytest.approx(extract_deadline + job.allowance("upscale", 100))
+
+
+def test_record_cost_is_a_moving_average(cost_model):
+    budget.record_cost("upscale", 4.0)
+    costs = json.loads(cost_model.read_text())
+    assert costs["upscale"] == pytest.approx(DEFAULT_COSTS["upscale"] + budget.COST_SMOOTHING * 2.0)
+    assert budget.load_costs()["extract"] == DEFAULT_COSTS["extract"]
+
+
+def test_finish_learns_from_the_measured_work(clock, cost_model):
+    job = megapixel_budget()
+    job.start("upscale", 100)
+    clock.now = 5
+    # 20 seconds of model runs over 5 frames, the rest came from the cache
+    job.finish("upscale", measured=(20.0, 5))
+    learned = json.loads(cost_model.read_text())["upscale"]
+    assert learned == pytest.approx(DEFAULT_COSTS["upscale"] + budget.COST_SMOOTHING * (4.0 - DEFAULT_COSTS["upscale"]))
+
+
+def test_unsized_jobs_get_fallback_allowances_and_learn_nothing(clock, cost_model):
+    job = JobBudget(0, 0, 2)
+    job.start("upscale", 10)
+    assert job.deadline == pytest.approx(budget.FALLBACK_SECONDS["upscale"][1] * 10)
+    job.finish("upscale", measured=(20.0, 5))
+    assert not cost_model.exists()
@@ -0,0 +1,48 @@
+from remux import plan_remux, audio_output_args, COPY, TRANSCODE, SILENCE
+
+
+def probe(format_name="mov,mp4,m4a,3gp,3g2,mj2", brand="isom", video="h264", audio="aac"):
+    streams = [{"codec_type": "video", "codec_name": video}]
+    if audio:
+        streams.append({"codec_type": "audio", "codec_name": audio})
+    return {"streams": streams, "format": {"format_name": format_name, "tags": {"major_brand": brand}}}
+
+
+def test_mp4_with_audio_is_a_noop():
+    plan = plan_remux(probe())
+    assert plan["video"] == COPY and plan["audio"] == COPY
+    assert plan["noop"]
+
+
+def test_quicktime_is_remuxed_even_with_mp4_codecs():
+    plan = plan_remux(probe(brand="qt  "))
+    assert plan["video"] == COPY and plan["audio"] == COPY
+    assert not plan["noop"]
+
+
+def test_codecs_mp4_does_not_take_are_transcoded():
+    plan = plan_remux(probe(format_name="matroska,webm", video="vp8", audio="vorbis"))
+    assert plan["video"] == TRANSCODE
+    assert plan["audio"] == TRANSCODE
+    assert plan["audio_codec"] == "vorbis"
+    assert not plan["noop"]
+
+
+def test_missing_audio_gets_silence():
+    plan = plan_remux(probe(audio=None))
+    assert plan["audio"] == SILENCE
+    assert not plan["noop"]
+
+
+def test_unprobed_file_copies_video_and_transcodes_audio():
+    plan = plan_remux({})
+    assert plan == {"video": COPY, "audio": TRANSCODE, "audio_codec": None, "probed": False, "noop": False}
+
+
+def test_audio_output_args():
+    assert audio_output_args(plan_remux(probe()), 0) == ["-map", "0:a:0", "-c:a", "copy"]
+    silence = audio_output_args(plan_remux(probe(audio=None)), 1)
+    assert silence[:2] == ["-map", "1:a:0"]
+    assert "-c:a" in silence and silence[-1] == "-shortest"
+    # An unprobed source may have no audio, so its map is optional
+    assert audio_output_args(plan_remux({}), 0)[:2] == ["-map", "0:a:0?"]
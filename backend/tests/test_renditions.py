@@ -0,0 +1,22 @@
+import pytest
+
+from renditions import parse_renditions, rendition_outputs, HLS, DASH, MP4
+
+
+def test_parse_renditions_sorts_largest_first_and_drops_duplicates():
+    assert parse_renditions("1280:720, 3840:2160,1920:1080,1280:720,") == [(3840, 2160), (1920, 1080), (1280, 720)]
+
+
+@pytest.mark.parametrize("spec", ["", " , ", "1280x720", "1280:", "0:720", "-1280:720", "a:b"])
+def test_parse_renditions_rejects_bad_input(spec):
+    with pytest.raises(ValueError):
+        parse_renditions(spec)
+
+
+def test_rendition_outputs():
+    sizes = [(1920, 1080), (1280, 720)]
+    assert rendition_outputs(sizes, MP4) == {
+        "manifest": None, "renditions": {"1920x1080": "1920x1080.mp4", "1280x720": "1280x720.mp4"}
+    }
+    assert rendition_outputs(sizes, HLS)["renditions"]["1280x720"] == "1280x720/index.m3u8"
+    assert rendition_outputs(sizes, DASH)["manifest"] == "manifest.mpd"
@@ -0,0 +1,40 @@
+import pytest
+
+from resources import derive_tuning
+
+GB = 1024 ** 3
+
+
+@pytest.fixture(autouse=True)
+def no_overrides(monkeypatch):
+    for name in ("JOB_WORKERS", "FFMPEG_THREADS", "FFMPEG_FILTER_THREADS", "UPSCALE_TILE_SIZE", "UPSCALE_IO_THREADS"):
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_slots_follow_cpus_and_are_shared_by_processes():
+    tuning = derive_tuning({"cpus": 16, "memory": 64 * GB, "temp_free": 100 * GB}, processes=2)
+    assert tuning["job_slots"] == 4
+    assert tuning["job_workers"] == 2
+    assert tuning["ffmpeg_threads"] == 4
+    assert tuning["upscale_io_threads"] == 2
+    assert tuning["upscale_tile_size"] == 0
+
+
+def test_memory_and_temp_space_limit_the_slots():
+    assert derive_tuning({"cpus": 16, "memory": 5 * GB, "temp_free": None})["job_slots"] == 2
+    assert derive_tuning({"cpus": 16, "memory": 64 * GB, "temp_free": 9 * GB})["job_slots"] == 2
+    # Every process keeps at least one worker
+    assert derive_tuning({"cpus": 2, "memory": 1 * GB, "temp_free": 1 * GB}, processes=4)["job_workers"] == 1
+
+
+def test_small_memory_gets_tiled_upscaling():
+    assert derive_tuning({"cpus": 4, "memory": 1.5 * GB, "temp_free": None})["upscale_tile_size"] == 256
+    assert derive_tuning({"cpus": 4, "memory": 0.5 * GB, "temp_free": None})["upscale_tile_size"] == 128
+
+
+def test_environment_overrides(monkeypatch):
+    monkeypatch.setenv("JOB_WORKERS", "3")
+    monkeypatch.setenv("FFMPEG_THREADS", "0")
+    tuning = derive_tuning({"cpus": 12, "memory": None, "temp_free": None})
+    assert tuning["job_workers"] == 3
+    assert tuning["ffmpeg_threads"] == 4
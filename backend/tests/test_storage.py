@@ -0,0 +1,140 @@
+import os
+import time
+import uuid
+
+import pytest
+
+from storage import StorageManager, InsufficientStorage, WORK_DIR_PREFIX, LOCK_FILE_PREFIX, LOCK_FILE_SUFFIX
+
+MB = 1024 * 1024
+
+
+def make_file(path: str, size: int, age: float = 0) -> str:
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    if age:
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+    return path
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setenv("STORAGE_BUDGET", "10MB")
+    monkeypatch.setenv("STORAGE_MIN_FREE", "0")
+    return StorageManager(str(tmp_path), [str(tmp_path)])
+
+
+def test_sweep_removes_orphaned_uploads(storage, tmp_path):
+    old = make_file(str(tmp_path / f"{uuid.uuid4()}_clip.mp4"), 10, age=storage.work_dir_ttl + 60)
+    recent = make_file(str(tmp_path / f"{uuid.uuid4()}_clip.mp4"), 10)
+    assert storage.sweep() == 10
+    assert not os.path.exists(old)
+    assert os.path.exists(recent)
+
+
+def test_sweep_keeps_held_inputs(storage, tmp_path):
+    held = make_file(str(tmp_path / f"{uuid.uuid4()}_clip.mp4"), 10, age=storage.work_dir_ttl + 60)
+    storage.hold_input(held)
+    assert storage.sweep() == 0
+    assert os.path.exists(held)
+    storage.release_input(held)
+    assert storage.sweep() == 10
+    assert not os.path.exists(held)
+
+
+def test_sweep_keeps_inputs_held_by_another_process(storage, tmp_path):
+    held = make_file(str(tmp_path / f"{uuid.uuid4()}_clip.mp4"), 10, age=storage.work_dir_ttl + 60)
+    other = StorageManager(str(tmp_path), [str(tmp_path)])
+    other.hold_input(held)
+    try:
+        assert storage.sweep() == 0
+        assert os.path.exists(held)
+    finally:
+        other.release_input(held)
+
+
+def test_reserve_sweeps_but_keeps_held_inputs(storage, tmp_path):
+    held = make_file(str(tmp_path / f"{uuid.uuid4()}_clip.mp4"), 6 * MB, age=storage.work_dir_ttl + 60)
+    storage.hold_input(held)
+    with pytest.raises(InsufficientStorage):
+        with storage.reserve(6 * MB):
+            pass
+    assert os.path.exists(held)
+
+
+def test_evict_skips_outputs_being_written(storage, tmp_path):
+    writing = make_file(str(tmp_path / f"{uuid.uuid4()}_upscaled.mp4"), 4 * MB, age=120)
+    finished = make_file(str(tmp_path / f"{uuid.uuid4()}_upscaled.mp4"), 4 * MB, age=60)
+    with storage.reserve(1024, output_path=writing):
+        with storage.reserve(4 * MB):
+            assert os.path.exists(writing)
+            assert not os.path.exists(finished)
+        with pytest.raises(InsufficientStorage):
+            with storage.reserve(7 * MB):
+                pass
+        assert os.path.exists(writing)
+
+
+def test_usage_counts_hard_linked_frames_once(storage, tmp_path):
+    work_dir = tmp_path / f"{WORK_DIR_PREFIX}job"
+    (work_dir / "cache").mkdir(parents=True)
+    frame = make_file(str(work_dir / "frame_000001.png"), MB)
+    os.link(frame, work_dir / "cache" / "digest.png")
+    make_file(str(tmp_path / f"{uuid.uuid4()}_upscaled.mp4"), 2 * MB)
+    make_file(str(tmp_path / f"{uuid.uuid4()}_clip.mp4"), 3 * MB)
+    usage = storage.usage()
+    assert (usage["work"], usage["outputs"], usage["uploads"]) == (MB, 2 * MB, 3 * MB)
+    assert usage["total"] == 6 * MB
+
+
+def test_reserve_charges_what_a_job_already_wrote_once(storage, tmp_path):
+    work_dir = tmp_path / f"{WORK_DIR_PREFIX}job"
+    work_dir.mkdir()
+    make_file(str(work_dir / "frame_000001.png"), 3 * MB)
+    with storage.reserve(5 * MB, job_key="job"):
+        assert storage.usage()["reserved"] == 2 * MB
+        # 3MB used and 2MB reserved leave 5MB of the budget
+        with storage.reserve(5 * MB):
+            pass
+        with pytest.raises(InsufficientStorage):
+            with storage.reserve(5 * MB + 1):
+                pass
+    assert storage.usage()["reserved"] == 0
+
+
+def test_sweep_removes_expired_outputs_and_stale_work(storage, tmp_path):
+    expired = make_file(str(tmp_path / f"{uuid.uuid4()}_upscaled.mp4"), 10, age=storage.output_ttl + 60)
+    fresh = make_file(str(tmp_path / f"{uuid.uuid4()}_upscaled.mp4"), 10)
+    old_dir = tmp_path / f"{WORK_DIR_PREFIX}old"
+    old_dir.mkdir()
+    make_file(str(old_dir / "checkpoint.json"), 10, age=storage.work_dir_ttl + 60)
+    os.utime(old_dir, (time.time() - storage.work_dir_ttl - 60,) * 2)
+    active_dir = tmp_path / f"{WORK_DIR_PREFIX}active"
+    active_dir.mkdir()
+    make_file(str(active_dir / "checkpoint.json"), 10)
+    stale_lock = make_file(str(tmp_path / f"{LOCK_FILE_PREFIX}old{LOCK_FILE_SUFFIX}"), 0, age=storage.work_dir_ttl + 60)
+    unrelated = make_file(str(tmp_path / "notes.txt"), 10, age=storage.output_ttl + 60)
+
+    assert storage.sweep() == 20
+    assert not os.path.exists(expired)
+    assert not old_dir.exists()
+    assert not os.path.exists(stale_lock)
+    assert os.path.exists(fresh)
+    assert active_dir.exists()
+    assert os.path.exists(unrelated)
+
+
+def test_evict_removes_least_recently_used_outputs_first(storage, tmp_path):
+    older = make_file(str(tmp_path / f"{uuid.uuid4()}_upscaled.mp4"), MB, age=180)
+    old = make_file(str(tmp_path / f"{uuid.uuid4()}_upscaled.mp4"), MB, age=120)
+    newer = make_file(str(tmp_path / f"{uuid.uuid4()}_upscaled.mp4"), MB, age=60)
+    upload = make_file(str(tmp_path / f"{uuid.uuid4()}_clip.mp4"), MB, age=240)
+    # A download makes an output recently used again
+    storage.touch(os.path.basename(older))
+    assert storage.evict(1) == MB
+    assert not os.path.exists(old)
+    assert storage.evict(MB) == MB
+    assert not os.path.exists(newer)
+    assert os.path.exists(older)
+    assert os.path.exists(upload)
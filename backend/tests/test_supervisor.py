@@ -0,0 +1,11 @@
+import sys
+
+from supervisor import run_process
+
+
+def test_run_process_keeps_output_that_is_not_utf8():
+    script = "import sys; sys.stderr.buffer.write(b'title: caf\\xe9\\n'); print('done')"
+    result = run_process([sys.executable, "-c", script])
+    assert result.returncode == 0
+    assert result.stderr == "title: caf�\n"
+    assert result.stdout == "done\n"
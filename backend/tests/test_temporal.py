@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+np = pytest.importorskip("numpy")
+
+from temporal import TemporalUpscaler, ANCHOR_INTERVAL
+
+
+def write_frames(directory, count):
+    """A square moving over a still textured background"""
+    rng = np.random.default_rng(0)
+    background = (rng.random((72, 128, 3)) * 255).astype(np.uint8)
+    background = cv2.GaussianBlur(background, (0, 0), 3)
+    paths = []
+    for i in range(count):
+        image = background.copy()
+        image[20:40, 10 + i:30 + i] = (0, 0, 255)
+        path = os.path.join(directory, f"frame_{i + 1:06d}.png")
+        cv2.imwrite(path, image)
+        paths.append(path)
+    return paths
+
+
+def test_one_model_run_per_batch(tmp_path):
+    runs = []
+
+    def upscale_batch(in_frames, out_frames, patches):
+        runs.append((list(in_frames), dict(patches)))
+        for in_frame, out_frame in zip(in_frames, out_frames):
+            image = cv2.imread(in_frame)
+            cv2.imwrite(out_frame, cv2.resize(image, None, fx=2, fy=2, interpolation=cv2.INTER_NEAREST))
+        return len(in_frames)
+
+    frames_dir = tmp_path / "frames"
+    upscaled_dir = tmp_path / "upscaled"
+    frames_dir.mkdir()
+    upscaled_dir.mkdir()
+    in_frames = write_frames(str(frames_dir), 2 * ANCHOR_INTERVAL)
+    out_frames = [str(upscaled_dir / os.path.basename(path)) for path in in_frames]
+    upscaler = TemporalUpscaler(2, str(tmp_path), upscale_batch)
+
+    half = len(in_frames) // 2
+    assert upscaler.process_batch(in_frames[:half], out_frames[:half])
+    assert upscaler.process_batch(in_frames[half:], out_frames[half:])
+
+    assert len(runs) == 2
+    assert upscaler.stats["anchors"] + upscaler.stats["warped"] == len(in_frames)
+    assert upscaler.stats["warped"] > 0
+    for path in out_frames:
+        assert cv2.imread(path).shape == (144, 256, 3)
+    for run_in, patches in runs:
+        # Mosaics are a part of a frame and are removed once pasted
+        assert all(0 < share < 1 for share in patches.values())
+        assert not any(os.path.exists(path) for path in patches)
@@ -0,0 +1,40 @@
+from video_processing import (
+    write_concat_list, load_checkpoint, save_checkpoint, _to_ranges, _from_ranges, FRAME_EXT, CHECKPOINT_FILE
+)
+
+
+def test_concat_list_has_one_entry_per_frame(tmp_path):
+    upscaled = tmp_path / "upscaled"
+    upscaled.mkdir()
+    for i in range(3):
+        (upscaled / f"frame_{i + 1:06d}.{FRAME_EXT}").write_bytes(b"")
+    list_path = tmp_path / "frames.txt"
+
+    assert write_concat_list(str(list_path), str(upscaled), [0.04, 0.04, 0.08])
+    lines = list_path.read_text().splitlines()
+    files = [line for line in lines if line.startswith("file ")]
+    assert len(files) == 3
+    assert files[-1].endswith(f"frame_000003.{FRAME_EXT}'")
+    assert lines[-1] == "duration 0.080000"
+
+
+def test_concat_list_needs_a_duration_per_frame(tmp_path):
+    (tmp_path / f"frame_000001.{FRAME_EXT}").write_bytes(b"")
+    assert not write_concat_list(str(tmp_path / "frames.txt"), str(tmp_path), [0.04, 0.04])
+
+
+def test_checkpoint_ranges_round_trip(tmp_path):
+    completed = {1, 2, 3, 5, 7, 8, 9}
+    assert _to_ranges(completed) == [[1, 3], [5, 5], [7, 9]]
+    assert _to_ranges([]) == []
+
+    checkpoint = load_checkpoint(str(tmp_path))
+    assert checkpoint == {"attempts": 0, "extracted": False, "completed": []}
+    checkpoint["completed"] = _to_ranges(completed)
+    save_checkpoint(str(tmp_path), checkpoint)
+    assert _from_ranges(load_checkpoint(str(tmp_path))["completed"]) == completed
+
+
+def test_unreadable_checkpoint_starts_over(tmp_path):
+    (tmp_path / CHECKPOINT_FILE).write_text("{not json")
+    assert load_checkpoint(str(tmp_path))["completed"] == []
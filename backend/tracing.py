@@ -0,0 +1,167 @@
+import io
+import os
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Opt-in cProfile of the Python side of every job, written to PROFILE_DIR
+PROFILE_JOBS = os.getenv('PROFILE_JOBS', 'false').lower() == 'true'
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_TOP = 30  # Functions listed in the profile summary kept with the trace
+
+
+class Trace:
+    """
+    Timeline of one job: named spans of pipeline stages and every child
+    process with its argv, exit code, CPU time and peak RSS. Spans and
+    processes may be recorded from several threads.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._origin = time.perf_counter()
+        self.spans = []
+        self.processes = []
+        self.profile = None  # pstats summary when the job was profiled
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Trace":
+        """Rebuild a trace saved with to_dict(), e.g. by another server process"""
+        trace = cls()
+        trace.started = data["started"]
+        trace.spans = list(data["spans"])
+        trace.processes = list(data["processes"])
+        trace.profile = data.get("profile")
+        return trace
+
+    def _now(self) -> float:
+        return time.perf_counter() - self._origin
+
+    @contextmanager
+    def span(self, name: str, **args):
+        start = self._now()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.spans.append({
+                    "name": name,
+                    "start": round(start, 6),
+                    "duration": round(self._now() - start, 6),
+                    "thread": threading.get_ident(),
+                    **({"args": args} if args else {}),
+                })
+
+    def add_process(self, argv: list, start: float, duration: float, returncode, rusage=None):
+        """Record a finished child process; start is a time.perf_counter() value"""
+        entry = {
+            "argv": [str(arg) for arg in argv],
+            "start": round(start - self._origin, 6),
+            "duration": round(duration, 6),
+            "returncode": returncode,
+            "thread": threading.get_ident(),
+        }
+        if rusage is not None:
+            entry.update(
+                user_cpu=round(rusage.ru_utime, 6),
+                system_cpu=round(rusage.ru_stime, 6),
+                # Kilobytes on Linux, and never below the server's own RSS when it forked
+                max_rss_kb=rusage.ru_maxrss,
+            )
+        with self._lock:
+            self.processes.append(entry)
+
+    def timings(self) -> dict:
+        """Total seconds per span name"""
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                totals[span["name"]] = round(totals.get(span["name"], 0.0) + span["duration"], 6)
+        return totals
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            processes = list(self.processes)
+            spans = list(self.spans)
+        return {
+            "started": self.started,
+            "timings": self.timings(),
+            "spans": spans,
+            "processes": processes,
+            "child_cpu_seconds": round(sum(p.get("user_cpu", 0) + p.get("system_cpu", 0) for p in processes), 6),
+            "child_max_rss_kb": max((p.get("max_rss_kb", 0) for p in processes), default=0),
+            "profile": self.profile,
+        }
+
+    def to_chrome(self) -> dict:
+        """Chrome trace-event JSON, for chrome://tracing or Perfetto"""
+        events = []
+        with self._lock:
+            for span in self.spans:
+                events.append({
+                    "name": span["name"], "cat": "stage", "ph": "X", "pid": 1, "tid": span["thread"],
+                    "ts": span["start"] * 1e6, "dur": span["duration"] * 1e6, "args": span.get("args", {}),
+                })
+            for process in self.processes:
+                args = {key: value for key, value in process.items() if key not in ("start", "duration", "thread")}
+                events.append({
+                    "name": os.path.basename(process["argv"][0]), "cat": "process", "ph": "X", "pid": 1,
+                    "tid": process["thread"], "ts": process["start"] * 1e6, "dur": process["duration"] * 1e6,
+                    "args": args,
+                })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+# Trace of the job running in the current task or thread (or copied context)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(name: str, **args):
+    """Time a block as a span of the current trace, if there is one"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name, **args):
+        yield
+
+
+def record_process(argv: list, start: float, duration: float, returncode, rusage=None):
+    """Record a child process in the current trace, if there is one"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_process(argv, start, duration, returncode, rusage)
+
+
+def run_profiled(name: str, fn, *args, **kwargs):
+    """
+    Call fn, under cProfile when PROFILE_JOBS is set. The profile is saved
+    as PROFILE_DIR/<name>.prof and a summary is kept with the current trace.
+    cProfile only sees the calling thread, which runs the job's orchestration.
+    """
+    if not PROFILE_JOBS:
+        return fn(*args, **kwargs)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}.prof"))
+        except OSError as e:
+            logger.warning(f"Could not save profile of {name}: {e}")
+        trace = current_trace.get()
+        if trace is not None:
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            trace.profile = summary.getvalue()
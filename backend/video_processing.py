@@ -4,15 +4,77 @@ import uuid
 import shutil
 import logging
 import tempfile
+import json
+import time
+import hashlib
+import re
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from remux import plan_remux, audio_input_args, audio_output_args, prepare_audio_command, SILENCE
+from renditions import rendition_output_args, MP4
+from supervisor import run_process, JobCancelled, JobInterrupted
+from budget import JobBudget, DeadlineExceeded
+from tracing import span
+from storage import LOCK_FILE_PREFIX, LOCK_FILE_SUFFIX, WORK_DIR_PREFIX, tree_size
+from resources import ffmpeg_thread_args, ffmpeg_decode_args, upscaler_args, cgroup_memory_limit, cgroup_memory_usage
+try:
+    import fcntl
+except ImportError:  # Windows: a single server process only
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
 # Path to the Real-ESRGAN executable (update if needed)
 REALESRGAN_BIN = "realesrgan-ncnn-vulkan"  # or 'realesrgan' if using the Python package
+REALESRGAN_MODEL = "realesrgan-x4plus"  # Use the best model
 
-# Supported image extension for Real-ESRGAN
+# Supported image extension for Real-ESRGAN output (it can only write png/jpg/webp)
 FRAME_EXT = "png"
 
+# Intermediate formats for extracted frames. Real-ESRGAN reads all of them;
+# the uncompressed ones skip a zlib pass on extract and on load.
+FRAME_FORMATS = {
+    "ppm": {"ext": "ppm", "args": [], "compressed": False},
+    "bmp": {"ext": "bmp", "args": ["-pix_fmt", "bgr24"], "compressed": False},
+    "png0": {"ext": "png", "args": ["-compression_level", "0"], "compressed": False},
+    "png": {"ext": "png", "args": [], "compressed": True},
+}
+# "auto" picks from free memory and disk speed, or name one of FRAME_FORMATS
+FRAME_FORMAT = os.getenv("FRAME_FORMAT", "auto")
+# Put work dirs on tmpfs when free memory covers the job this many times over.
+# Its pages count as memory, against the container's limit too.
+TMPFS_DIR = "/dev/shm"
+TMPFS_HEADROOM = 2.0
+TMPFS_LOCK_KEY = "tmpfs"  # Held while a job claims tmpfs, see open_work_dir
+# Below this write speed (MB/s) compressed frames are cheaper than disk I/O
+FAST_DISK_MBPS = 200
+
+# Checkpoint / retry settings
+CHECKPOINT_FILE = "checkpoint.json"
+AUDIO_FILE = "audio.mka"  # Audio prepared alongside the upscale, any codec fits Matroska
+CACHE_DIR = "cache"  # Upscaled frames by source frame digest, shared by preview and full job
+FRAME_TIMES_FILE = "frame_times.json"  # Display duration of every extracted frame
+
+# Frame rate handling: "native" upscales every source frame, "adaptive"
+# upscales at a reduced rate and rebuilds the rest by frame interpolation
+FRAME_RATE_MODES = ("native", "adaptive")
+ADAPTIVE_DIVISOR = 2  # Adaptive mode upscales every Nth frame...
+ADAPTIVE_MIN_FPS = 12  # ...but never drops below this rate
+SHOWINFO_PTS = re.compile(r"pts_time:\s*(-?[0-9.]+)")
+FRAME_RETRIES = 3  # Attempts per frame before the job fails
+RETRY_BACKOFF = 1.0  # Seconds to wait after the first failed attempt, doubled each retry
+MAX_JOB_ATTEMPTS = 3  # Failed runs after which a job's temp data is discarded
+# Frames per Real-ESRGAN run: the model is loaded once per batch and the
+# checkpoint is saved after each one
+UPSCALE_BATCH_SIZE = int(os.getenv('UPSCALE_BATCH_SIZE', 16))
+
+# Runs of the same job share its work dir and must not overlap, in this
+# process or in another server worker
+_job_locks = {}
+_job_locks_guard = threading.Lock()
+
 def get_temp_dir():
     """Get temporary directory that works on both local and cloud environments"""
     temp_dir = tempfile.gettempdir()
@@ -22,107 +84,960 @@ def get_temp_dir():
         os.makedirs(temp_dir, exist_ok=True)
     return temp_dir
 
-def upscale_with_realesrgan(input_path, output_path, scale="2"):
+def get_work_roots():
+    """Get the directories work dirs may be created in, disk first"""
+    roots = [get_temp_dir()]
+    if os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK):
+        roots.append(TMPFS_DIR)
+    return roots
+
+def get_work_dir(job_key, root=None):
+    """
+    Get the work directory holding frames and checkpoint for a job. Without
+    a root, an existing work dir of the job is looked up in every work root.
+    """
+    name = f"{WORK_DIR_PREFIX}{job_key}"
+    if root is None:
+        for candidate in get_work_roots():
+            if os.path.isdir(os.path.join(candidate, name)):
+                return os.path.join(candidate, name)
+        root = get_temp_dir()
+    return os.path.join(root, name)
+
+def probe_media(input_path):
+    """Probe streams and format of a media file with ffprobe, {} on failure"""
+    probe_cmd = [
+        "ffprobe", "-v", "error", "-show_streams", "-show_format", "-of", "json", input_path
+    ]
+    try:
+        with span("probe"):
+            result = run_process(probe_cmd, timeout=30)
+        if result.returncode != 0:
+            logger.warning(f"FFprobe error: {result.stderr}")
+            return {}
+        return json.loads(result.stdout)
+    except (subprocess.TimeoutExpired, OSError, ValueError) as e:
+        logger.warning(f"FFprobe failed for {input_path}: {e}")
+        return {}
+
+def _available_memory():
+    """
+    Bytes of memory available without swapping or hitting the cgroup's
+    memory limit, 0 when unknown
+    """
+    available = 0
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    limit = cgroup_memory_limit()
+    if limit:
+        # MemAvailable is the host's; a container is killed at its own limit
+        headroom = max(limit - (cgroup_memory_usage() or 0), 0)
+        available = min(available, headroom) if available else headroom
+    return available
+
+def _tmpfs_claimed():
+    """
+    Bytes jobs on tmpfs, in any server process, are still expected to
+    write: what each claimed (see open_work_dir) less what it holds already
+    """
+    claimed = 0
+    try:
+        entries = list(os.scandir(TMPFS_DIR))
+    except OSError:
+        return 0
+    for entry in entries:
+        if entry.name.startswith(WORK_DIR_PREFIX) and entry.is_dir(follow_symlinks=False):
+            work_bytes = load_checkpoint(entry.path).get("work_bytes", 0)
+            claimed += max(work_bytes - tree_size(entry.path), 0)
+    return claimed
+
+_disk_speed_cache = {}
+
+def measure_write_speed(directory, size=32 * 1024 * 1024):
+    """Measure sequential write speed of a directory in MB/s (cached per directory)"""
+    if directory in _disk_speed_cache:
+        return _disk_speed_cache[directory]
+    path = os.path.join(directory, f".write_test_{uuid.uuid4()}")
+    block = os.urandom(1024 * 1024)
+    try:
+        start = time.perf_counter()
+        with open(path, "wb") as f:
+            for _ in range(size // len(block)):
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        elapsed = time.perf_counter() - start
+        speed = size / (1024 * 1024) / max(elapsed, 1e-6)
+    except OSError as e:
+        logger.warning(f"Could not measure write speed of {directory}: {e}")
+        speed = 0.0
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    _disk_speed_cache[directory] = speed
+    return speed
+
+def selected_duration(probe, time_ranges=None):
+    """Seconds of video a job processes: the selected ranges, or the whole file"""
+    if time_ranges:
+        return sum(end - start for start, end in time_ranges)
+    return float(probe.get("format", {}).get("duration") or 0)
+
+def _parse_rate(rate, default=30.0):
+    """Parse an ffprobe frame rate like '30000/1001'"""
+    try:
+        if "/" in rate:
+            num, denom = map(int, rate.split("/"))
+            return num / denom if denom != 0 else default
+        return float(rate) or default
+    except (TypeError, ValueError):
+        return default
+
+def _video_stream(probe):
+    return next((st for st in probe.get("streams", []) if st.get("codec_type") == "video"), {})
+
+def source_fps(probe):
+    """Average frame rate of the source, which also holds for variable frame rate video"""
+    video = _video_stream(probe)
+    return _parse_rate(video.get("avg_frame_rate"), _parse_rate(video.get("r_frame_rate")))
+
+def extraction_fps(probe, frame_rate_mode="native"):
+    """Rate frames are extracted at: None for every source frame, or the adaptive rate"""
+    if frame_rate_mode != "adaptive":
+        return None
+    fps = source_fps(probe)
+    target = max(fps / ADAPTIVE_DIVISOR, min(fps, ADAPTIVE_MIN_FPS))
+    return target if target < fps else None
+
+def estimate_frame_count(probe, time_ranges=None, frame_rate_mode="native"):
+    """Number of frames a job extracts and upscales"""
+    duration = selected_duration(probe, time_ranges)
+    fps = extraction_fps(probe, frame_rate_mode) or source_fps(probe)
+    return int(duration * fps) + 1
+
+def job_budget(probe, scale):
+    """Deadline budget of a job on a probed file, with fallback allowances when the probe lacks size or duration"""
+    video = _video_stream(probe)
+    if not selected_duration(probe):
+        return JobBudget(0, 0, scale)
+    return JobBudget(int(video.get("width") or 0), int(video.get("height") or 0), scale)
+
+def estimate_work_bytes(probe, scale, time_ranges=None, frame_rate_mode="native"):
+    """Estimate uncompressed bytes of extracted plus upscaled frames"""
+    video = _video_stream(probe)
+    width = int(video.get("width") or 0)
+    height = int(video.get("height") or 0)
+    frames = estimate_frame_count(probe, time_ranges, frame_rate_mode)
+    return frames * width * height * 3 * (1 + int(scale) ** 2)
+
+def choose_frame_format(probe, scale, time_ranges=None, frame_rate_mode="native"):
+    """
+    Choose the intermediate frame format and the work root for a job:
+    - uncompressed frames on tmpfs when free memory comfortably holds them
+    - uncompressed frames on disk when the disk is fast
+    - compressed PNG when disk I/O would cost more than zlib
+    FRAME_FORMAT overrides the format; the work root is still chosen.
+    """
+    work_bytes = estimate_work_bytes(probe, scale, time_ranges, frame_rate_mode)
+    root = get_temp_dir()
+    if work_bytes and TMPFS_DIR in get_work_roots():
+        # Other jobs on tmpfs take their share of memory as they write frames
+        claimed = _tmpfs_claimed()
+        tmpfs_free = shutil.disk_usage(TMPFS_DIR).free - claimed
+        if _available_memory() - claimed > work_bytes * TMPFS_HEADROOM and tmpfs_free > work_bytes:
+            root = TMPFS_DIR
+    if FRAME_FORMAT in FRAME_FORMATS:
+        frame_format = FRAME_FORMAT
+    elif root == TMPFS_DIR or measure_write_speed(root) >= FAST_DISK_MBPS:
+        frame_format = "ppm"
+    else:
+        frame_format = "png"
+    logger.info(f"Using {frame_format} frames in {root} (about {work_bytes} bytes uncompressed)")
+    return frame_format, root
+
+def _frame_index(frame):
+    """Get the frame number from a name like frame_000042.png"""
+    return int(os.path.splitext(frame)[0].split("_")[-1])
+
+def _to_ranges(indices):
+    """Collapse frame numbers into [start, end] ranges for compact storage"""
+    ranges = []
+    for index in sorted(indices):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+def _from_ranges(ranges):
+    """Expand [start, end] ranges back into a set of frame numbers"""
+    indices = set()
+    for start, end in ranges:
+        indices.update(range(start, end + 1))
+    return indices
+
+def load_checkpoint(work_dir):
+    """Load the checkpoint of a job, or a fresh one if none was written yet"""
+    checkpoint = {"attempts": 0, "extracted": False, "completed": []}
+    path = os.path.join(work_dir, CHECKPOINT_FILE)
+    try:
+        with open(path) as f:
+            checkpoint.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable checkpoint {path}: {e}")
+    return checkpoint
+
+def save_checkpoint(work_dir, checkpoint):
+    """Write the checkpoint atomically so a crash never leaves it half written"""
+    path = os.path.join(work_dir, CHECKPOINT_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+def run_with_retry(cmd, label, output_path=None, budget=None):
+    """
+    Run a command, retrying transient failures with exponential backoff.
+    A partial output file left by a failed attempt is removed before retrying.
+    With a JobBudget every attempt is limited to what is left of the
+    current stage, and DeadlineExceeded is raised instead of retrying once
+    it is used up.
+    """
+    delay = RETRY_BACKOFF
+    for attempt in range(1, FRAME_RETRIES + 1):
+        if budget:
+            budget.check()
+        try:
+            result = run_process(cmd, timeout=budget.timeout() if budget else None)
+            if result.returncode == 0:
+                return True
+            logger.warning(f"{label} failed (attempt {attempt}/{FRAME_RETRIES}): {result.stderr}")
+        except subprocess.TimeoutExpired:
+            if budget:
+                budget.check()  # Killed by the deadline, not a transient failure
+            logger.warning(f"{label} timed out (attempt {attempt}/{FRAME_RETRIES})")
+        if output_path and os.path.exists(output_path):
+            os.remove(output_path)
+        if attempt < FRAME_RETRIES:
+            time.sleep(delay)
+            delay *= 2
+    return False
+
+def open_work_dir(job_key, probe, scale, time_ranges=None, frame_rate_mode="native"):
+    """
+    Open the work dir of a job, creating it on the work root and with the
+    frame format chosen for the job if it does not exist yet.
+    Returns the work dir and its checkpoint.
+    """
+    work_dir = get_work_dir(job_key)
+    if os.path.isdir(work_dir):
+        checkpoint = load_checkpoint(work_dir)
+        # Format of work dirs checkpointed before formats were recorded
+        checkpoint.setdefault("frame_format", "png")
+        return work_dir, checkpoint
+    # Jobs choosing tmpfs at the same time would each see all of its room free
+    with _job_lock(TMPFS_LOCK_KEY):
+        frame_format, root = choose_frame_format(probe, scale, time_ranges, frame_rate_mode)
+        work_dir = get_work_dir(job_key, root)
+        os.makedirs(work_dir, exist_ok=True)
+        checkpoint = load_checkpoint(work_dir)
+        checkpoint["frame_format"] = frame_format
+        if root == TMPFS_DIR:
+            # The claim on tmpfs, read by jobs choosing after this one
+            checkpoint["work_bytes"] = estimate_work_bytes(probe, scale, time_ranges, frame_rate_mode)
+            save_checkpoint(work_dir, checkpoint)
+    return work_dir, checkpoint
+
+def planned_frame_format(job_key, probe, scale, time_ranges=None, frame_rate_mode="native"):
+    """Frame format a job will use: that of its existing work dir, or the one it would choose now"""
+    work_dir = get_work_dir(job_key)
+    if os.path.isdir(work_dir):
+        return load_checkpoint(work_dir).get("frame_format", "png")
+    return choose_frame_format(probe, scale, time_ranges, frame_rate_mode)[0]
+
+def upscale_with_realesrgan(input_path, output_path, scale="2", job_key=None, probe=None,
+                            time_ranges=None, frame_rate_mode="native", temporal=False,
+                            renditions=None, packaging=MP4, progress=None):
     """
     Upscale a video using Real-ESRGAN with optimized processing:
     1. Extract frames with optimized settings
     2. Upscale frames with Real-ESRGAN
     3. Reassemble video with high quality
+
+    Progress is checkpointed in the job's work dir. When a job with the same
+    job_key runs again after a failure it skips extraction and every frame
+    that was already upscaled. The work dir is kept until the job succeeds or
+    has failed MAX_JOB_ATTEMPTS times. Without a job_key the job cannot be
+    resumed and its work dir is always removed. Pass the ffprobe output as
+    probe when the caller already has it.
+
+    time_ranges, a list of [start, end] seconds, limits the job to those
+    parts of the video: only they are decoded and upscaled, and the output
+    is their concatenation with matching audio. The job_key must then
+    differ per selection.
+
+    Frames keep the timing of the source: with frame_rate_mode "native"
+    every source frame is upscaled once and shown for its original
+    duration. "adaptive" upscales at a reduced rate (see extraction_fps)
+    and interpolates the frames in between when reassembling.
+
+    temporal runs the model only on anchor frames and builds the others by
+    optical flow warping (see temporal.py).
+
+    renditions, a list of (width, height), makes output_path a directory
+    receiving every rendition from the one upscale pass, packaged as MP4
+    files, HLS or DASH according to packaging (see reassemble_video).
+
+    progress(stage, done, total) is called as the "extract", "upscale" and
+    "reassemble" stages advance.
+    """
+    with nullcontext() if job_key is None else _job_lock(job_key):
+        return _run_upscale_job(input_path, output_path, scale, job_key, probe, time_ranges, frame_rate_mode,
+                                temporal, renditions, packaging, progress)
+
+@contextmanager
+def _job_lock(job_key):
     """
-    temp_dir = get_temp_dir()
-    work_dir = os.path.join(temp_dir, f"realesrgan_{uuid.uuid4()}")
+    Hold a job key against other threads and, through a lock file, against
+    other server processes on the host, which share the work dirs
+    """
+    with _job_locks_guard:
+        lock = _job_locks.setdefault(job_key, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(get_temp_dir(), f"{LOCK_FILE_PREFIX}{job_key}{LOCK_FILE_SUFFIX}"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+def _run_upscale_job(input_path, output_path, scale, job_key, probe, time_ranges, frame_rate_mode,
+                     temporal, renditions, packaging, progress):
+    if probe is None:
+        probe = probe_media(input_path)
+    resumable = job_key is not None
+    work_dir, checkpoint = open_work_dir(
+        job_key if resumable else uuid.uuid4(), probe, scale, time_ranges, frame_rate_mode
+    )
+    fps = extraction_fps(probe, frame_rate_mode)
     frames_dir = os.path.join(work_dir, "frames")
     upscaled_dir = os.path.join(work_dir, "upscaled")
     
     os.makedirs(frames_dir, exist_ok=True)
     os.makedirs(upscaled_dir, exist_ok=True)
+
+    # Stage timeouts follow from the size of the job and the learned cost per frame
+    budget = job_budget(probe, scale)
+    frame_count = estimate_frame_count(probe, time_ranges, frame_rate_mode)
     
+    audio_path = os.path.join(work_dir, AUDIO_FILE)
+    # Audio is prepared while frames are extracted and upscaled, so the
+    # final mux only has to stream-copy it
+    audio_pool = ThreadPoolExecutor(max_workers=1)
+    audio_future = None
+    if not (checkpoint.get("audio_ready") and os.path.exists(audio_path)):
+        checkpoint["audio_ready"] = False
+        # The audio runs under the same job control, so a cancel kills it too
+        audio_future = audio_pool.submit(
+            contextvars.copy_context().run, prepare_audio, input_path, probe, audio_path, time_ranges,
+            budget.job_allowance(frame_count)
+        )
+    succeeded = False
+    cancelled = interrupted = False
     try:
-        # 1. Extract frames with optimized settings
-        extract_cmd = [
-            "ffmpeg", "-i", input_path,
-            "-vf", "fps=30",  # Limit to 30fps for processing efficiency
+        if checkpoint["extracted"]:
+            logger.info(f"Resuming from checkpoint in {work_dir}")
+        else:
+            # Discard frames left by an interrupted extraction
+            shutil.rmtree(frames_dir, ignore_errors=True)
+            os.makedirs(frames_dir, exist_ok=True)
+            frame_times = []
+            selection = time_ranges or [(None, None)]
+            budget.start("extract", frame_count)
+            for done, (start, end) in enumerate(selection, 1):
+                # Number frames of consecutive ranges continuously
+                with span("extract", start=start, end=end):
+                    durations = extract_frames(
+                        input_path, frames_dir, checkpoint["frame_format"], start=start,
+                        duration=end - start if end is not None else None,
+                        start_number=len(frame_times) + 1, fps=fps, timeout=budget.timeout()
+                    )
+                if durations is None:
+                    budget.check()
+                    return False
+                frame_times.extend(durations)
+                if progress:
+                    progress("extract", done, len(selection))
+            with open(os.path.join(work_dir, FRAME_TIMES_FILE), "w") as f:
+                json.dump(frame_times, f)
+            frame_count = len(os.listdir(frames_dir))
+            budget.finish("extract", frame_count)
+            checkpoint["extracted"] = True
+            save_checkpoint(work_dir, checkpoint)
+
+        frame_ext = FRAME_FORMATS[checkpoint["frame_format"]]["ext"]
+        with span("upscale"):
+            upscaled = upscale_frames(frames_dir, upscaled_dir, scale, work_dir, checkpoint, frame_ext, temporal,
+                                      progress, budget)
+        if not upscaled:
+            return False
+        if progress:
+            progress("reassemble", 0, 1)
+        frame_count = len(os.listdir(upscaled_dir))
+
+        if audio_future is not None:
+            with span("audio_wait"):
+                checkpoint["audio_ready"] = audio_future.result()
+            audio_future = None
+        prepared_audio = audio_path if checkpoint["audio_ready"] else None
+        # Each rendition is another encode of every frame
+        budget.start("reassemble", frame_count * max(len(renditions or ()), 1))
+        with span("reassemble", renditions=len(renditions or ()) or 1):
+            succeeded = reassemble_video(input_path, upscaled_dir, output_path, probe, prepared_audio,
+                                         trimmed=bool(time_ranges), frame_times=load_frame_times(work_dir),
+                                         interpolate=fps is not None, renditions=renditions, packaging=packaging,
+                                         timeout=budget.timeout())
+        if not succeeded:
+            budget.check()
+            return False
+        budget.finish("reassemble")
+        if progress:
+            progress("reassemble", 1, 1)
+        return succeeded
+        
+    except DeadlineExceeded as e:
+        # The checkpoint is kept, a retry with more time resumes from it
+        logger.error(f"Stopping job early: {e}")
+        raise
+    except JobInterrupted:
+        # The server is shutting down; the checkpoint is kept for a retry
+        logger.info(f"Job interrupted, keeping {work_dir}")
+        interrupted = True
+        raise
+    except JobCancelled:
+        logger.info(f"Job cancelled, discarding {work_dir}")
+        cancelled = True
+        raise
+    except Exception as e:
+        logger.error(f"Error in Real-ESRGAN upscaling: {e}", exc_info=True)
+        return False
+    finally:
+        audio_pool.shutdown(wait=True)
+        if audio_future is not None and audio_future.exception() is None:
+            # Keep audio finished before a failure for the resumed run
+            checkpoint["audio_ready"] = audio_future.result()
+        if succeeded or cancelled or not resumable:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        elif interrupted:
+            try:
+                save_checkpoint(work_dir, checkpoint)
+            except OSError as e:
+                logger.error(f"Failed to save checkpoint in {work_dir}: {e}")
+        else:
+            _record_failed_attempt(work_dir, checkpoint)
+
+def _record_failed_attempt(work_dir, checkpoint):
+    """Count a failed run; keep temp data for a resume or drop it once abandoned"""
+    checkpoint["attempts"] += 1
+    if checkpoint["attempts"] >= MAX_JOB_ATTEMPTS:
+        logger.error(f"Job failed {checkpoint['attempts']} times, abandoning {work_dir}")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return
+    try:
+        save_checkpoint(work_dir, checkpoint)
+        logger.info(f"Kept checkpoint in {work_dir} for resume")
+    except OSError as e:
+        logger.error(f"Failed to save checkpoint in {work_dir}: {e}")
+
+def extract_frames(input_path, frames_dir, frame_format="png", start=None, duration=None, max_frames=None,
+                   start_number=1, fps=None, timeout=None):
+    """
+    Extract frames with optimized settings in one of FRAME_FORMATS.
+    start/duration (seconds) limit extraction to an excerpt: the input is
+    seeked to the keyframe before start, decoded frames before start are
+    dropped and output stops after duration, so the cut is frame-exact
+    without decoding the rest of the file. max_frames stops after that many
+    frames, and files are numbered from start_number.
+
+    Every source frame is extracted exactly once unless fps resamples to a
+    lower rate. Returns how long each extracted frame is displayed, from
+    the source timestamps, or None on failure or after timeout seconds.
+    """
+    fmt = FRAME_FORMATS[frame_format]
+    # showinfo logs the timestamp of every frame that is written
+    video_filter = f"fps={fps},showinfo" if fps else "showinfo"
+    existing = len(os.listdir(frames_dir))
+    try:
+        extract_cmd = ["ffmpeg", *ffmpeg_decode_args()]
+        if start:
+            extract_cmd.extend(["-ss", f"{start:.3f}"])
+        extract_cmd.extend(["-i", input_path])
+        if duration:
+            extract_cmd.extend(["-t", f"{duration:.3f}"])
+        if max_frames:
+            extract_cmd.extend(["-frames:v", str(max_frames)])
+        extract_cmd.extend([
+            "-vf", video_filter,
+            "-fps_mode", "passthrough",  # No duplicated or dropped frames
             "-q:v", "2",  # High quality frames
-            os.path.join(frames_dir, f"frame_%06d.{FRAME_EXT}")
-        ]
+            *fmt["args"],
+            *ffmpeg_thread_args(),
+            "-start_number", str(start_number),
+            os.path.join(frames_dir, f"frame_%06d.{fmt['ext']}")
+        ])
         logger.info(f"Extracting frames: {' '.join(extract_cmd)}")
-        result = subprocess.run(extract_cmd, capture_output=True, text=True, timeout=300)
+        result = run_process(extract_cmd, timeout=timeout)
         if result.returncode != 0:
             logger.error(f"FFmpeg extract error: {result.stderr}")
+            return None
+    except subprocess.TimeoutExpired:
+        logger.error("Frame extraction timed out")
+        return None
+
+    written = len(os.listdir(frames_dir)) - existing
+    times = [float(t) for t in SHOWINFO_PTS.findall(result.stderr)][:written]
+    durations = [max(later - earlier, 0.001) for earlier, later in zip(times, times[1:])]
+    if times:
+        # The last frame lasts until the end of the excerpt, or as long as the one before
+        default = durations[-1] if durations else 1 / (fps or 30)
+        remaining = duration - times[-1] if duration else 0
+        durations.append(remaining if remaining > 0 else default)
+    if len(durations) != written:
+        logger.warning("Frame timestamps unavailable, assuming a constant frame rate")
+        durations = []
+    return durations
+
+def upscale_frames(frames_dir, upscaled_dir, scale, work_dir, checkpoint, frame_ext=FRAME_EXT, temporal=False,
+                   progress=None, budget=None):
+    """
+    Upscale frames with Real-ESRGAN in batches of UPSCALE_BATCH_SIZE, one
+    model run per batch. Frames recorded as completed in the checkpoint are
+    skipped, and the checkpoint is saved after every batch. Upscaled frames
+    are always written as FRAME_EXT, whatever the extracted frame format.
+
+    With temporal the model only runs on anchor frames and the frames in
+    between are warped from them with optical flow (see temporal.py), still
+    one model run per batch.
+    progress(stage, done, total) is called after every batch. With a
+    JobBudget the pending frames get an "upscale" stage budget, each model
+    run is limited to what is left of it, and DeadlineExceeded is raised
+    as soon as the rate of the batches shows it will be missed. The cost
+    model learns from the model runs only, not from cached or warped frames.
+    """
+    frame_files = sorted([f for f in os.listdir(frames_dir) if f.endswith(f".{frame_ext}")])
+    completed = _from_ranges(checkpoint["completed"])
+    pending = [f for f in frame_files if _frame_index(f) not in completed]
+    if completed:
+        logger.info(f"Skipping {len(frame_files) - len(pending)} frames already upscaled")
+    cache_dir = os.path.join(work_dir, CACHE_DIR)
+    if budget:
+        budget.start("upscale", len(pending))
+    # Time and frames of the model runs; a mosaic of temporal patches
+    # counts for its share of a frame's pixels
+    model = {"seconds": 0.0, "frames": 0}
+
+    def run_model(in_frames, out_frames, patches=None):
+        began = time.perf_counter()
+        ran = upscale_frame_batch(in_frames, out_frames, scale, cache_dir, work_dir, budget, patches)
+        if ran:
+            model["seconds"] += time.perf_counter() - began
+            model["frames"] += ran
+        return ran
+
+    temporal_upscaler = None
+    if temporal:
+        from temporal import TemporalUpscaler
+        temporal_upscaler = TemporalUpscaler(scale, work_dir, run_model)
+    batch_size = UPSCALE_BATCH_SIZE
+    
+    for i in range(0, len(pending), batch_size):
+        batch = pending[i:i + batch_size]
+        in_frames = [os.path.join(frames_dir, frame) for frame in batch]
+        out_frames = [os.path.join(upscaled_dir, f"{os.path.splitext(frame)[0]}.{FRAME_EXT}") for frame in batch]
+        if temporal_upscaler is not None:
+            if not temporal_upscaler.process_batch(in_frames, out_frames):
+                if budget:
+                    budget.check()
+                return False
+        elif run_model(in_frames, out_frames) is None:
             return False
+        completed.update(_frame_index(frame) for frame in batch)
 
-        # 2. Upscale frames with Real-ESRGAN (process in batches for memory efficiency)
-        frame_files = sorted([f for f in os.listdir(frames_dir) if f.endswith(f".{FRAME_EXT}")])
-        batch_size = 10  # Process 10 frames at a time
-        
-        for i in range(0, len(frame_files), batch_size):
-            batch = frame_files[i:i + batch_size]
-            for frame in batch:
-                in_frame = os.path.join(frames_dir, frame)
-                out_frame = os.path.join(upscaled_dir, frame)
-                
-                realsr_cmd = [
-                    REALESRGAN_BIN,
-                    "-i", in_frame,
-                    "-o", out_frame,
-                    "-s", scale,
-                    "-n", "realesrgan-x4plus"  # Use the best model
-                ]
-                
-                logger.info(f"Upscaling frame {frame} with scale {scale}")
-                result = subprocess.run(realsr_cmd, capture_output=True, text=True, timeout=60)
-                if result.returncode != 0:
-                    logger.error(f"Real-ESRGAN error for {frame}: {result.stderr}")
-                    return False
+        checkpoint["completed"] = _to_ranges(completed)
+        save_checkpoint(work_dir, checkpoint)
+        if progress:
+            progress("upscale", len(frame_files) - len(pending) + i + len(batch), len(frame_files))
+        if budget:
+            budget.advance("upscale", i + len(batch))
+    if temporal_upscaler is not None:
+        logger.info(f"Temporal upscale: {temporal_upscaler.stats}")
+    if budget:
+        budget.finish("upscale", measured=(model["seconds"], model["frames"]))
+    return True
+
+def _file_digest(path):
+    """SHA-1 of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _link_or_copy(src, dst):
+    try:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def upscale_frame(in_frame, out_frame, scale, cache_dir, budget=None):
+    """
+    Upscale one frame with Real-ESRGAN, each attempt limited to what is
+    left of the budget's current stage. Frames whose content was upscaled before (by a preview, or a
+    duplicate frame of the same job) are taken from cache_dir instead of
+    running the model again. Without a cache_dir the cache is not used.
+    Returns True when the model ran, False on a cache hit, None on failure.
+    """
+    cached = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cached = os.path.join(cache_dir, f"{_file_digest(in_frame)}.{FRAME_EXT}")
+        if os.path.exists(cached):
+            _link_or_copy(cached, out_frame)
+            return False
+
+    realsr_cmd = [
+        REALESRGAN_BIN,
+        "-i", in_frame,
+        "-o", out_frame,
+        "-s", scale,
+        "-n", REALESRGAN_MODEL,
+        *upscaler_args()
+    ]
+    frame = os.path.basename(in_frame)
+    logger.info(f"Upscaling frame {frame} with scale {scale}")
+    if not run_with_retry(realsr_cmd, f"Real-ESRGAN on {frame}", out_frame, budget):
+        logger.error(f"Real-ESRGAN gave up on {frame}")
+        return None
+    if cached is not None:
+        _link_or_copy(out_frame, cached)
+    return True
+
+def upscale_frame_batch(in_frames, out_frames, scale, cache_dir, work_dir, budget=None, patches=None):
+    """
+    Upscale several frames with a single Real-ESRGAN run in directory mode,
+    so the model is loaded once for the whole batch, within what is left of
+    the budget's current stage. Cached frames are reused and identical
+    frames are upscaled once. Frames the batch run
+    did not produce are retried one by one with upscale_frame.
+    patches maps the mosaics of temporal patches among in_frames to their
+    share of a frame's pixels: they never recur, so they are kept out of the
+    frame cache, and count for that share of a frame in the result.
+    Returns the number of frames the model ran on, None on failure.
+    """
+    patches = patches or {}
+    os.makedirs(cache_dir, exist_ok=True)
+    todo = {}  # Source digest (or mosaic name) -> [(in_frame, out_frame)] still to upscale
+    for in_frame, out_frame in zip(in_frames, out_frames):
+        if in_frame in patches:
+            todo[os.path.splitext(os.path.basename(in_frame))[0]] = [(in_frame, out_frame)]
+            continue
+        digest = _file_digest(in_frame)
+        cached = os.path.join(cache_dir, f"{digest}.{FRAME_EXT}")
+        if os.path.exists(cached):
+            _link_or_copy(cached, out_frame)
+        else:
+            todo.setdefault(digest, []).append((in_frame, out_frame))
+    if not todo:
+        return 0
 
-        # 3. Reassemble video with high quality settings
-        # Get original framerate and audio info
-        probe_cmd = [
-            "ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries",
-            "stream=r_frame_rate", "-of", "default=noprint_wrappers=1:nokey=1", input_path
+    batch_in = os.path.join(work_dir, "batch_in")
+    batch_out = os.path.join(work_dir, "batch_out")
+    for path in (batch_in, batch_out):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+    try:
+        for digest, frames in todo.items():
+            in_frame = frames[0][0]
+            _link_or_copy(in_frame, os.path.join(batch_in, digest + os.path.splitext(in_frame)[1]))
+        realsr_cmd = [
+            REALESRGAN_BIN,
+            "-i", batch_in,
+            "-o", batch_out,
+            "-s", scale,
+            "-n", REALESRGAN_MODEL,
+            "-f", FRAME_EXT,
+            *upscaler_args()
         ]
-        
-        try:
-            framerate = subprocess.check_output(probe_cmd, timeout=30).decode().strip()
-            if "/" in framerate:
-                num, denom = map(int, framerate.split("/"))
-                fps = num / denom if denom != 0 else 30
-            else:
-                fps = float(framerate)
-        except:
-            fps = 30  # Default framerate
-        
-        # Check if input has audio
-        audio_check_cmd = [
-            "ffprobe", "-v", "error", "-select_streams", "a", "-show_entries",
-            "stream=codec_type", "-of", "default=noprint_wrappers=1:nokey=1", input_path
+        logger.info(f"Upscaling {len(todo)} frames with scale {scale}")
+        run_with_retry(realsr_cmd, f"Real-ESRGAN on {len(todo)} frames", budget=budget)
+
+        for digest, frames in todo.items():
+            result = os.path.join(batch_out, f"{digest}.{FRAME_EXT}")
+            in_frame, out_frame = frames[0]
+            if in_frame in patches:
+                if os.path.exists(result):
+                    os.replace(result, out_frame)
+                elif upscale_frame(in_frame, out_frame, scale, None, budget) is None:
+                    return None
+                continue
+            cached = os.path.join(cache_dir, f"{digest}.{FRAME_EXT}")
+            if os.path.exists(result):
+                os.replace(result, cached)
+            elif upscale_frame(in_frame, out_frame, scale, cache_dir, budget) is None:
+                return None
+            for _, out_frame in frames:
+                _link_or_copy(cached, out_frame)
+        return sum(patches.get(frames[0][0], 1) for frames in todo.values())
+    finally:
+        shutil.rmtree(batch_in, ignore_errors=True)
+        shutil.rmtree(batch_out, ignore_errors=True)
+
+def preview_upscale(input_path, output_prefix, scale="2", job_key=None, probe=None,
+                    samples=3, sample_duration=0.5):
+    """
+    Upscale a few short excerpts spread over the video to preview the result.
+    With sample_duration 0 only one frame per sample is upscaled.
+
+    Writes <output_prefix>_before.png / _after.png stills of the first
+    sample and, for excerpts, a silent <output_prefix>_preview.mp4 of all
+    samples. Upscaled frames are kept in the job's frame cache, so the full
+    job with the same job_key does not upscale them again.
+
+    Returns a dict with the file paths and a projection of the full job's
+    frame count and upscale time, or None on failure.
+    """
+    # The work dir is shared with the full job of the same key
+    with nullcontext() if job_key is None else _job_lock(job_key):
+        return _run_preview(input_path, output_prefix, scale, job_key, probe, samples, sample_duration)
+
+def _run_preview(input_path, output_prefix, scale, job_key, probe, samples, sample_duration):
+    if probe is None:
+        probe = probe_media(input_path)
+    resumable = job_key is not None
+    work_dir, checkpoint = open_work_dir(job_key if resumable else uuid.uuid4(), probe, scale)
+    if resumable:
+        # Record the frame format so the full job extracts the same frames
+        save_checkpoint(work_dir, checkpoint)
+    preview_dir = os.path.join(work_dir, f"preview_{uuid.uuid4()}")
+    frames_dir = os.path.join(preview_dir, "frames")
+    upscaled_dir = os.path.join(preview_dir, "upscaled")
+    os.makedirs(frames_dir)
+    os.makedirs(upscaled_dir)
+    frame_ext = FRAME_FORMATS[checkpoint["frame_format"]]["ext"]
+    cache_dir = os.path.join(work_dir, CACHE_DIR)
+    duration = float(probe.get("format", {}).get("duration") or 0)
+    # The preview is budgeted as one upscale stage for its samples, but
+    # does not train the cost model: it mixes extraction and model runs
+    budget = job_budget(probe, scale)
+    budget.start("upscale", samples * max(int(sample_duration * source_fps(probe)), 1))
+
+    try:
+        # Samples centred in equal slices of the video
+        starts = [
+            max(0.0, duration * (i + 0.5) / samples - sample_duration / 2) for i in range(samples)
+        ] if duration else [0.0]
+        model_time = 0.0
+        model_frames = 0
+        frame_count = 0
+        for start in starts:
+            sample_dir = os.path.join(frames_dir, f"{frame_count:06d}")
+            os.makedirs(sample_dir)
+            if extract_frames(input_path, sample_dir, checkpoint["frame_format"], start=start,
+                              duration=sample_duration or None,
+                              max_frames=None if sample_duration else 1, timeout=budget.timeout()) is None:
+                return None
+            for frame in sorted(os.listdir(sample_dir)):
+                frame_count += 1
+                # Number preview frames continuously across samples
+                in_frame = os.path.join(frames_dir, f"frame_{frame_count:06d}.{frame_ext}")
+                os.replace(os.path.join(sample_dir, frame), in_frame)
+                out_frame = os.path.join(upscaled_dir, f"frame_{frame_count:06d}.{FRAME_EXT}")
+                began = time.perf_counter()
+                ran_model = upscale_frame(in_frame, out_frame, scale, cache_dir, budget)
+                if ran_model is None:
+                    return None
+                if ran_model:
+                    model_time += time.perf_counter() - began
+                    model_frames += 1
+        if not frame_count:
+            logger.error("Preview extracted no frames")
+            return None
+
+        before_path = f"{output_prefix}_before.png"
+        after_path = f"{output_prefix}_after.png"
+        shutil.copyfile(os.path.join(upscaled_dir, f"frame_000001.{FRAME_EXT}"), after_path)
+        still_cmd = [
+            "ffmpeg", "-i", os.path.join(frames_dir, f"frame_000001.{frame_ext}"), "-y", before_path
         ]
-        
-        has_audio = False
-        try:
-            audio_result = subprocess.run(audio_check_cmd, capture_output=True, text=True, timeout=30)
-            has_audio = "audio" in audio_result.stdout
-        except:
-            pass
+        budget.start("reassemble", frame_count)
+        result = run_process(still_cmd, timeout=budget.timeout())
+        if result.returncode != 0:
+            logger.error(f"FFmpeg preview still error: {result.stderr}")
+            return None
+
+        clip_path = None
+        if sample_duration:
+            clip_path = f"{output_prefix}_preview.mp4"
+            clip_cmd = [
+                "ffmpeg", "-framerate", f"{source_fps(probe):.6f}", "-i",
+                os.path.join(upscaled_dir, f"frame_%06d.{FRAME_EXT}"),
+                "-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-pix_fmt", "yuv420p",
+                *ffmpeg_thread_args(), "-movflags", "+faststart", "-y", clip_path
+            ]
+            result = run_process(clip_cmd, timeout=budget.timeout())
+            if result.returncode != 0:
+                logger.error(f"FFmpeg preview clip error: {result.stderr}")
+                return None
+
+        total_frames = estimate_frame_count(probe) if duration else frame_count
+        per_frame = model_time / model_frames if model_frames else None
+        remaining = max(total_frames - frame_count, 0)
+        return {
+            "before_path": before_path,
+            "after_path": after_path,
+            "clip_path": clip_path,
+            "preview_frames": frame_count,
+            "frame_format": checkpoint["frame_format"],
+            "total_frames": total_frames,
+            "seconds_per_frame": per_frame,
+            "projected_upscale_seconds": per_frame * remaining if per_frame is not None else None,
+        }
+    except subprocess.TimeoutExpired:
+        logger.error("Preview timed out")
+        return None
+    except Exception as e:
+        logger.error(f"Error in preview upscaling: {e}", exc_info=True)
+        return None
+    finally:
+        if resumable:
+            shutil.rmtree(preview_dir, ignore_errors=True)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def prepare_audio(input_path, probe, audio_path, time_ranges=None, timeout=None):
+    """
+    Extract, transcode or synthesise the audio track of a job following its
+    remux plan, cut to time_ranges if given. Returns False when the audio
+    has to be handled by the final mux instead, also when it takes longer
+    than timeout seconds.
+    """
+    plan = plan_remux(probe)
+    duration = selected_duration(probe, time_ranges)
+    audio_cmd = prepare_audio_command(plan, input_path, audio_path, duration, time_ranges)
+    if not audio_cmd:
+        return False
+    logger.info(f"Preparing audio: {' '.join(audio_cmd)}")
+    try:
+        with span("audio"):
+            result = run_process(audio_cmd, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.warning("Audio preparation timed out, muxing audio at reassembly")
+        return False
+    if result.returncode != 0:
+        logger.warning(f"Audio preparation failed, muxing audio at reassembly: {result.stderr}")
+        return False
+    return True
+
+def load_frame_times(work_dir):
+    """Load the display duration of every extracted frame, [] if unknown"""
+    try:
+        with open(os.path.join(work_dir, FRAME_TIMES_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def write_concat_list(list_path, upscaled_dir, frame_times):
+    """
+    Write an ffmpeg concat list showing every upscaled frame for its source
+    duration. Returns False when the durations do not match the frames.
+    """
+    frames = sorted(f for f in os.listdir(upscaled_dir) if f.endswith(f".{FRAME_EXT}"))
+    if not frames or len(frames) != len(frame_times):
+        return False
+    # The concat demuxer only applies the duration of the last file when the
+    # entry is repeated, which would add a frame to the output. Without that
+    # the last frame gets ffmpeg's default duration; the audio still ends on time
+    with open(list_path, "w") as f:
+        for frame, duration in zip(frames, frame_times):
+            f.write(f"file '{os.path.abspath(os.path.join(upscaled_dir, frame))}'\n")
+            f.write(f"duration {duration:.6f}\n")
+    return True
+
+def reassemble_video(input_path, upscaled_dir, output_path, probe=None, audio_path=None, trimmed=False,
+                     frame_times=None, interpolate=False, renditions=None, packaging=MP4, timeout=None):
+    """
+    Reassemble video with high quality settings. Audio prepared in advance
+    (audio_path) is stream-copied. Otherwise it is muxed in the same pass
+    following the remux plan of the source: copied when MP4 accepts its
+    codec, transcoded when not, and a silent track when there is none.
+    The source audio does not line up with trimmed frames, so those get
+    silence when no prepared audio is available.
+
+    With frame_times every frame keeps its source duration, so variable
+    frame rate sources keep their timing. interpolate rebuilds the source
+    frame rate from frames extracted at a reduced rate by blending
+    neighbouring frames.
+
+    With renditions, a list of (width, height), output_path is a directory
+    and the frames are decoded once and encoded to every rendition in the
+    same pass, packaged as MP4 files, HLS or DASH (see renditions.py).
+    The encode is given timeout seconds.
+    """
+    if probe is None:
+        probe = probe_media(input_path)
+    try:
+        fps = source_fps(probe)
+        list_path = os.path.join(os.path.dirname(upscaled_dir), "frames.txt")
         
         # Build reassemble command
-        reassemble_cmd = [
-            "ffmpeg", "-framerate", str(fps), "-i",
-            os.path.join(upscaled_dir, f"frame_%06d.{FRAME_EXT}")
-        ]
-        
-        if has_audio:
-            reassemble_cmd.extend(["-i", input_path, "-map", "0:v:0", "-map", "1:a:0?"])
+        if frame_times and write_concat_list(list_path, upscaled_dir, frame_times):
+            reassemble_cmd = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", list_path]
         else:
-            reassemble_cmd.extend(["-i", input_path, "-map", "0:v:0"])
-        
-        reassemble_cmd.extend([
-            "-c:v", "libx264", "-preset", "medium", "-crf", "18",
-            "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart", "-y", output_path
-        ])
+            # Without timestamps assume frames at a constant rate
+            rate = extraction_fps(probe, "adaptive") if interpolate else fps
+            reassemble_cmd = [
+                "ffmpeg", "-framerate", str(rate), "-i",
+                os.path.join(upscaled_dir, f"frame_%06d.{FRAME_EXT}")
+            ]
+        if audio_path:
+            reassemble_cmd.extend(["-i", audio_path])
+            audio_args = ["-map", "1:a:0", "-c:a", "copy"]
+        else:
+            plan = plan_remux(probe)
+            if trimmed:
+                plan.update(audio=SILENCE, probed=True)
+            reassemble_cmd.extend(audio_input_args(plan, input_path))
+            audio_args = audio_output_args(plan, 1)
+        interpolate_filter = f"framerate=fps={fps:.6f}" if interpolate else None
+        if renditions:
+            os.makedirs(output_path, exist_ok=True)
+            reassemble_cmd.extend(rendition_output_args(
+                renditions, packaging, output_path, audio_args[1], audio_args[2:],
+                pre_filter=interpolate_filter, vfr=not interpolate, thread_args=ffmpeg_thread_args()
+            ))
+        else:
+            reassemble_cmd.extend(["-map", "0:v:0", *audio_args])
+            if interpolate:
+                reassemble_cmd.extend(["-vf", interpolate_filter])
+            else:
+                reassemble_cmd.extend(["-fps_mode", "vfr"])
+            reassemble_cmd.extend([
+                "-c:v", "libx264", "-preset", "medium", "-crf", "18", *ffmpeg_thread_args(),
+                "-movflags", "+faststart", "-y", output_path
+            ])
         
         logger.info(f"Reassembling video: {' '.join(reassemble_cmd)}")
-        result = subprocess.run(reassemble_cmd, capture_output=True, text=True, timeout=600)
+        result = run_process(reassemble_cmd, timeout=timeout)
         if result.returncode != 0:
             logger.error(f"FFmpeg reassemble error: {result.stderr}")
             return False
@@ -131,14 +1046,5 @@ def upscale_with_realesrgan(input_path, output_path, scale="2"):
         return True
         
     except subprocess.TimeoutExpired:
-        logger.error("Process timed out")
-        return False
-    except Exception as e:
-        logger.error(f"Error in Real-ESRGAN upscaling: {e}", exc_info=True)
-        return False
-    finally:
-        # Clean up temp dirs
-        try:
-            shutil.rmtree(work_dir, ignore_errors=True)
-        except:
-            pass 
\ No newline at end of file
+        logger.error("Reassembly timed out")
+        return False 
\ No newline at end of file
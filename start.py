@@ -31,7 +31,7 @@ def run_backend():
         else:
             python_path = os.path.join(venv_path, 'bin', 'python')
         
-        cmd = [python_path, '-m', 'uvicorn', 'main:app', '--reload', '--host', '0.0.0.0', '--port', '8000']
+        cmd = [python_path, '-m', 'uvicorn', 'app:app', '--reload', '--host', '0.0.0.0', '--port', '8000']
         
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
         
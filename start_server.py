@@ -10,13 +10,6 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 print(f"Python executable: {sys.executable}")
 print(f"Python version: {sys.version}")
 
-try:
-    import ffmpeg
-    print("✓ ffmpeg import successful")
-except ImportError as e:
-    print(f"✗ ffmpeg import failed: {e}")
-    sys.exit(1)
-
 try:
     from backend.app import app
     print("✓ backend.app import successful")
@@ -27,4 +20,6 @@ except ImportError as e:
 if __name__ == "__main__":
     print("Starting FastAPI server...")
     import uvicorn
-    uvicorn.run("backend.app:app", host="127.0.0.1", port=8000, reload=True) 
\ No newline at end of file
+    # Reloading is for development only; production runs backend/serve.py
+    debug = os.getenv('DEBUG', 'false').lower() == 'true'
+    uvicorn.run("backend.app:app", host="127.0.0.1", port=8000, reload=debug) 
\ No newline at end of file